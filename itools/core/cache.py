@@ -116,3 +116,92 @@ class LRUCache(OrderedDict):
         self.last.next = node
         self.last = node
 
+
+
+
+class WeightedLRUCache(object):
+    """A LRU cache bound by the number of values ("length_max") and by their
+    total weight ("weight_max"), for instance their size in memory.  None
+    means no limit.  When a limit is surpassed the least-recently used values
+    are removed; a value heavier than "weight_max" is not cached at all.
+
+    The weight of a value is given to 'set', or else computed by the
+    "get_weight" function (0 if there is not any).  The cache keeps the
+    statistics of its use (see get_stats).
+    """
+
+    def __init__(self, length_max=None, weight_max=None, get_weight=None):
+        self.length_max = length_max
+        self.weight_max = weight_max
+        self.get_weight = get_weight
+        self.entries = LRUCache(1, automatic=False) # {key: (value, weight)}
+        self.weight = 0
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.touch(key)
+        return entry[0]
+
+
+    def set(self, key, value, weight=None):
+        entries = self.entries
+        if key in entries:
+            self.weight -= entries.pop(key)[1]
+
+        if weight is None:
+            get_weight = self.get_weight
+            weight = get_weight(value) if get_weight else 0
+
+        # Do not cache what does not fit
+        length_max = self.length_max
+        weight_max = self.weight_max
+        if weight_max is not None and weight > weight_max:
+            return
+
+        entries[key] = (value, weight)
+        self.weight += weight
+
+        # Free memory if needed
+        while ((length_max is not None and len(entries) > length_max) or
+               (weight_max is not None and self.weight > weight_max)):
+            key, entry = entries.popitem()
+            self.weight -= entry[1]
+            self.evictions += 1
+
+
+    def clear(self):
+        if self.entries:
+            self.entries.clear()
+            self.weight = 0
+
+
+    def get_stats(self):
+        hits = self.hits
+        total = hits + self.misses
+        return {
+            'hits': hits,
+            'misses': self.misses,
+            'ratio': (float(hits) / total) if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'weight': self.weight,
+            'length_max': self.length_max,
+            'weight_max': self.weight_max}
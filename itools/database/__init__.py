@@ -17,16 +17,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from itools
-from catalog import Catalog, make_catalog
+from catalog import Catalog, make_catalog, register_analyzer
+from catalog import shard_by_hash, shard_by_prefix, register_shard_router
 from fields import Field
 from queries import AllQuery, NotQuery, StartQuery, TextQuery
 from queries import RangeQuery, PhraseQuery, AndQuery, OrQuery, pprint_query
 from magic_ import magic_from_buffer, magic_from_file
 from metadata import Metadata
 from registry import get_register_fields, register_field
+from registry import get_register_sort_profiles, register_sort_profile
 from resources import Resource
 from ro import RODatabase, ReadonlyError
 from rw import RWDatabase, make_git_database, check_database
+from rw import reindex_catalog
 
 
 __all__ = [
@@ -38,8 +41,11 @@ __all__ = [
     'RWDatabase',
     'make_git_database',
     'check_database',
+    'reindex_catalog',
     'get_register_fields',
     'register_field',
+    'get_register_sort_profiles',
+    'register_sort_profile',
     # Metadata
     'Metadata',
     # Resources
@@ -48,6 +54,10 @@ __all__ = [
     # Xapian
     'make_catalog',
     'Catalog',
+    'register_analyzer',
+    'shard_by_hash',
+    'shard_by_prefix',
+    'register_shard_router',
     # Queries
     'RangeQuery',
     'PhraseQuery',
@@ -18,34 +18,54 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the standard library
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from cStringIO import StringIO
 from datetime import datetime
 from marshal import dumps, loads
 from hashlib import sha1
+from time import time
+from zlib import crc32
 
 # Import from xapian
 from xapian import Database, WritableDatabase, DB_CREATE, DB_OPEN
 from xapian import Document, Query, QueryParser, Enquire, MultiValueSorter
 from xapian import sortable_serialise, sortable_unserialise, TermGenerator
+from xapian import ValueCountMatchSpy, Stem, InvalidArgumentError
+from xapian import QueryParserError, inmemory_open
+import xapian
 
 # Import from itools
-from itools.core import fixed_offset, lazy
+from itools.core import WeightedLRUCache, fixed_offset, lazy
 from itools.datatypes import Integer, Unicode, String
 from itools.fs import lfs
-from itools.i18n import is_punctuation
-from itools.log import log_warning
+from itools.i18n import is_punctuation, split_punctuation
+from itools.log import log_debug, log_warning
+from registry import get_register_sort_profiles
 from queries import AllQuery, _AndQuery, NotQuery, _OrQuery, PhraseQuery
 from queries import RangeQuery, StartQuery, TextQuery, _MultipleQuery
+from queries import pprint_query
 
 
 
 # Constants
 OP_AND = Query.OP_AND
 OP_AND_NOT = Query.OP_AND_NOT
+OP_FILTER = Query.OP_FILTER
 OP_OR = Query.OP_OR
 OP_PHRASE = Query.OP_PHRASE
 OP_VALUE_RANGE = Query.OP_VALUE_RANGE
 OP_VALUE_GE = Query.OP_VALUE_GE
 OP_VALUE_LE = Query.OP_VALUE_LE
+# Wildcards expanding to too many terms keep the most frequent (Xapian 1.4)
+WILDCARD_LIMIT_MOST_FREQUENT = getattr(Query, 'WILDCARD_LIMIT_MOST_FREQUENT',
+                                       None)
+# Raised when a wildcard expands to too many terms (before Xapian 1.3 this
+# is a QueryParserError)
+WildcardError = getattr(xapian, 'WildcardError', QueryParserError)
+# The term added to the documents of the overlay (the prefixed terms start
+# with an upper case letter, see _get_prefix)
+OVERLAY_TERM = '_overlay'
 TQ_FLAGS = (QueryParser.FLAG_LOVEHATE +
             QueryParser.FLAG_PHRASE +
             QueryParser.FLAG_WILDCARD)
@@ -69,6 +89,59 @@ TRANSLATE_MAP = { ord(u'À'): ord(u'A'),
                   ord(u'ù'): ord(u'u'),
                   ord(u'ü'): ord(u'u'),
                   ord(u"'"): ord(u' ') }
+# The same, as a table indexed by code point (faster than a dict)
+FOLD_TABLE = [ TRANSLATE_MAP.get(i, i) for i in range(256) ]
+FOLD_TABLE = tuple(FOLD_TABLE)
+
+
+
+class Analyzer(object):
+    """Splits the text of a given language in words to be indexed.  The
+    Xapian term generator (and the stemmer) is built once, and reused for
+    every value.
+
+    By default there is not stemming.  If stemming is enabled the words are
+    indexed twice: as they are and stemmed (with the 'Z' prefix).
+    """
+
+    def __init__(self, language, stemming=False):
+        self.language = language
+        self.term_generator = TermGenerator()
+        self.stemmer = None
+        if stemming:
+            try:
+                self.stemmer = Stem(language)
+            except InvalidArgumentError:
+                log_warning('no stemmer for the "%s" language' % language)
+            else:
+                self.term_generator.set_stemmer(self.stemmer)
+
+
+    def index_text(self, xdoc, value, prefix, termpos):
+        tg = self.term_generator
+        tg.set_document(xdoc)
+        tg.set_termpos(termpos - 1)
+        # Suppress the accents
+        value = value.translate(FOLD_TABLE)
+        tg.index_text(value, 1, prefix)
+        return tg.get_termpos() + 1
+
+
+
+analyzers_registry = {}
+
+def register_analyzer(language, stemming=False):
+    """Defines the analyzer for the given language.  Note that the catalog
+    must be reindexed after the analyzers are changed.
+    """
+    analyzers_registry[language] = Analyzer(language, stemming)
+
+
+def get_analyzer(language):
+    analyzer = analyzers_registry.get(language)
+    if analyzer is None:
+        analyzer = analyzers_registry[language] = Analyzer(language)
+    return analyzer
 
 
 
@@ -142,25 +215,179 @@ class Doc(object):
 
 
 
+class SearchCache(WeightedLRUCache):
+    """A LRU cache for the search results, the keys are built from the
+    queries and the parameters of 'get_documents' (see _get_query_key).
+
+    The cache is bound by the number of entries ("size_max") and by the
+    total number of documents held by the entries ("docs_max"), which is
+    what takes memory: the weight of an entry is its number of documents.
+
+    The cache must be cleared whenever the catalog changes, this is done
+    by the catalog itself.
+    """
+
+    def __init__(self, size_max=500, docs_max=20000):
+        super(SearchCache, self).__init__(size_max, docs_max)
+
+
+
+class QueryStats(object):
+    """Collects the statistics of the searches done in a catalog: for every
+    match the time spent by Xapian, the number of documents returned, the
+    sort mode, and the time spent decoding the documents.
+
+    The searches slower than "slow_threshold" (in seconds) are logged, with
+    the itools query and the Xapian query, in the 'itools.database.slow'
+    domain.  The aggregated counters are returned by get_stats, and the
+    functions added with add_hook are called with every record.
+    """
+
+    def __init__(self, slow_threshold=1.0):
+        self.slow_threshold = slow_threshold
+        self.hooks = []
+        self.reset()
+
+
+    def reset(self):
+        self.searches = 0
+        self.slow = 0
+        self.docs = 0
+        self.match_time = 0.0
+        self.fetch_time = 0.0
+        self.max_time = 0.0
+
+
+    def add_hook(self, hook):
+        """The given function will be called with a dict for every search,
+        with the keys: query, xquery, sort, match_time, size and
+        fetch_time (the time to fetch the documents and build the results,
+        not to decode their values, which is done when they are read).
+        """
+        self.hooks.append(hook)
+
+
+    def record(self, query, xquery, sort, match_time, size, fetch_time=0.0):
+        # Update the counters
+        self.searches += 1
+        self.docs += size
+        self.match_time += match_time
+        self.fetch_time += fetch_time
+        total = match_time + fetch_time
+        if total > self.max_time:
+            self.max_time = total
+
+        # Slow query, or hooks: the queries are formatted
+        threshold = self.slow_threshold
+        slow = threshold is not None and total > threshold
+        if slow:
+            self.slow += 1
+        elif not self.hooks:
+            return
+
+        record = {
+            'query': _format_query(query),
+            'xquery': xquery.get_description(),
+            'sort': sort,
+            'match_time': match_time,
+            'size': size,
+            'fetch_time': fetch_time}
+        for hook in self.hooks:
+            hook(record)
+
+        if slow:
+            msg = ('slow search ({match_time:.3f}s match, {fetch_time:.3f}s'
+                   ' fetch, {size} docs, sort {sort}):\n{query}\n{xquery}')
+            log_warning(msg.format(**record), domain='itools.database.slow')
+
+
+    def get_stats(self):
+        searches = self.searches
+        total = self.match_time + self.fetch_time
+        return {
+            'searches': searches,
+            'slow': self.slow,
+            'docs': self.docs,
+            'match_time': self.match_time,
+            'fetch_time': self.fetch_time,
+            'max_time': self.max_time,
+            'mean_time': (total / searches) if searches else 0.0}
+
+
+
 class SearchResults(object):
 
-    def __init__(self, database, xquery):
+    def __init__(self, database, xquery, key=None, query=None,
+                 deadline=None):
         self._database = database
         self._xquery = xquery
+        # The cache key (None if the results are not to be cached)
+        self._key = key
+        # The itools queries, for the statistics (a list with the query
+        # objects and keyword parameters, see _format_query)
+        self._query = query or []
+        # The time limit of every match, in seconds; if it is reached the
+        # results are guessed to be partial (see _record)
+        self._deadline = deadline
+        self.partial = False
+
+
+    def _record(self, sort, t0, t1, size, t2=None):
+        """Record the statistics of a match done at t0 and ended at t1; if
+        the documents were fetched, this ended at t2.  The values of the
+        documents are decoded later, when they are read, so this time does
+        not include it.
+
+        If the match lasted as long as the deadline the results are flagged
+        as partial.  This is a guess from the wall-clock time: Xapian does
+        not tell whether the time limit stopped the match (and with Xapian
+        1.2 there is not a time limit, see _get_enquire).
+        """
+        deadline = self._deadline
+        if deadline and t1 - t0 >= deadline:
+            self.partial = True
+
+        fetch_time = (t2 - t1) if t2 is not None else 0.0
+        stats = self._database.catalog.query_stats
+        stats.record(self._query, self._xquery, sort, t1 - t0, size,
+                     fetch_time)
+
+
+    def _get_enquire(self, xquery):
+        enquire = self._database.catalog._get_enquire(xquery)
+        # Time limit (Xapian >= 1.4)
+        deadline = self._deadline
+        if deadline and hasattr(enquire, 'set_time_limit'):
+            enquire.set_time_limit(deadline)
+        return enquire
+
+
+    def _cache_set(self, key, value, docs=0):
+        """Partial results are not cached.
+        """
+        if not self.partial:
+            self._database.catalog.search_cache.set(key, value, docs)
 
 
     @lazy
     def _enquire(self):
-        enquire = Enquire(self._database.catalog._db)
-        enquire.set_query(self._xquery)
-        return enquire
+        return self._get_enquire(self._xquery)
 
 
     @lazy
     def _max(self):
-        enquire = self._enquire
-        max = enquire.get_mset(0, 0).get_matches_upper_bound()
-        return enquire.get_mset(0, max).size()
+        key = self._key
+        if key is None:
+            return self.get_count(exact=True)
+
+        # Cache
+        cache = self._database.catalog.search_cache
+        key = (key, 'len')
+        count = cache.get(key)
+        if count is None:
+            count = self.get_count(exact=True)
+            self._cache_set(key, count)
+        return count
 
 
     def __len__(self):
@@ -168,18 +395,131 @@ class SearchResults(object):
         return self._max
 
 
+    def get_count(self, exact=False):
+        """Returns the number of documents found.
+
+        By default the count is an estimate, computed by Xapian without
+        checking every match; it is returned as a tuple with three values:
+
+          (lower bound, estimate, upper bound)
+
+        If "exact" is True then Xapian is asked to check every match (with
+        'checkatleast'), but without building the list of documents, and
+        the exact count is returned as an integer.
+        """
+        enquire = self._enquire
+        if exact is False:
+            t0 = time()
+            mset = enquire.get_mset(0, 0)
+            self._record('count', t0, time(), 0)
+            return (mset.get_matches_lower_bound(),
+                    mset.get_matches_estimated(),
+                    mset.get_matches_upper_bound())
+
+        doccount = self._database.catalog._get_doccount()
+        t0 = time()
+        mset = enquire.get_mset(0, 0, doccount)
+        self._record('count', t0, time(), 0)
+        return mset.get_matches_estimated()
+
+
+    def get_facets(self, names, limit=None):
+        """Returns the number of documents found for every value of the given
+        stored fields, as a dict from field name to a dict from value to
+        count:
+
+          {'format': {'webpage': 10, 'file': 3}, ...}
+
+        All the fields are counted in the same match pass.  If "limit" is
+        given, only the most frequent values of every field are returned.
+        """
+        key = self._key
+        if key is not None:
+            key = (key, 'facets', tuple(names), limit)
+            cache = self._database.catalog.search_cache
+            facets = cache.get(key)
+            if facets is None:
+                facets = self._get_facets(names, limit)
+                self._cache_set(key, facets)
+            return facets
+
+        return self._get_facets(names, limit)
+
+
+    def _get_facets(self, names, limit):
+        catalog = self._database.catalog
+        metadata = catalog._metadata
+        fields = catalog._fields
+
+        # Add a match spy for every field
+        spies = []
+        for name in names:
+            info = metadata.get(name)
+            if info is None or 'value' not in info:
+                warn_not_stored(name)
+                continue
+            field_cls = _get_field_cls(name, fields, info)
+            spy = ValueCountMatchSpy(info['value'])
+            spies.append((name, field_cls, spy))
+
+        # Match (check every document, so the counts are exact)
+        enquire = self._enquire
+        for name, field_cls, spy in spies:
+            enquire.add_matchspy(spy)
+        t0 = time()
+        try:
+            enquire.get_mset(0, 0, catalog._get_doccount())
+        finally:
+            enquire.clear_matchspies()
+        self._record('facets', t0, time(), 0)
+
+        # Decode
+        facets = {}
+        for name, field_cls, spy in spies:
+            counts = facets[name] = {}
+            multiple = field_cls.multiple
+            if limit and not multiple:
+                items = spy.top_values(limit)
+            else:
+                items = spy.values()
+
+            for item in items:
+                raw_value = item.term
+                if not raw_value:
+                    continue
+                value = _decode(field_cls, raw_value)
+                if multiple:
+                    for x in value:
+                        counts[x] = counts.get(x, 0) + item.termfreq
+                else:
+                    counts[value] = item.termfreq
+
+            # Multiple: the limit is applied once the values are split
+            if limit and multiple and len(counts) > limit:
+                items = sorted(counts.iteritems(), key=lambda x: -x[1])
+                facets[name] = dict(items[:limit])
+
+        return facets
+
+
     def search(self, query=None, **kw):
         database = self._database
 
+        key = self._key
+        if key is not None:
+            key = (key, _get_query_key(query, kw))
+
         xquery = _get_xquery(database.catalog, query, **kw)
-        query = Query(Query.OP_AND, [self._xquery, xquery])
-        return self.__class__(database, query)
+        xquery = Query(Query.OP_AND, [self._xquery, xquery])
+        query = self._query + [query if query is not None else kw]
+        return self.__class__(database, xquery, key, query, self._deadline)
 
 
-    def get_documents(self, sort_by=None, reverse=False, start=0, size=0):
+    def get_documents(self, sort_by=None, reverse=False, start=0, size=0,
+                      fields=None):
         """Returns the documents for the search, sorted by weight.
 
-        Four optional arguments are accepted, which will modify the documents
+        Five optional arguments are accepted, which will modify the documents
         returned.
 
         First, it is possible to sort by a field, or a list of fields, instead
@@ -194,6 +534,10 @@ class SearchResults(object):
             or from greater to smaller (reverse is True). This parameter only
             takes effect if the parameter "sort_by" is also given.
 
+        If the list of fields given by "sort_by" matches a sort profile (or
+        "sort_by" is the name of a sort profile), the sort key precomputed
+        by the catalog is used.
+
         It is also possible to ask for a subset of the documents:
 
           - "start": returns the documents starting from the given start
@@ -202,14 +546,46 @@ class SearchResults(object):
           - "size": returns at most documents as specified by this parameter.
 
         By default all the documents are returned.
+
+        Finally, it is possible to ask only for some fields:
+
+          - "fields", if given it must be a list of names of stored fields.
+            Then the documents are returned as compact rows (named tuples)
+            with only these fields, decoded at once.
         """
+        catalog = self._database.catalog
+
+        # Cache
+        key = self._key
+        if key is not None:
+            if type(sort_by) is list:
+                sort_by = tuple(sort_by)
+            if fields is not None:
+                fields = tuple(fields)
+            key = (key, sort_by, reverse, start, size, fields)
+            cache = catalog.search_cache
+            results = cache.get(key)
+            if results is None:
+                results = self._get_documents(sort_by, reverse, start, size,
+                                              fields)
+                self._cache_set(key, results, len(results))
+            return list(results)
+
+        return self._get_documents(sort_by, reverse, start, size, fields)
+
+
+    def _get_documents(self, sort_by, reverse, start, size, fields):
         enquire = self._enquire
         catalog = self._database.catalog
 
         # sort_by != None
         metadata = catalog._metadata
         if sort_by is not None:
-            if isinstance(sort_by, list):
+            # A precomputed sort key
+            value = catalog._get_sort_value(sort_by)
+            if value is not None:
+                enquire.set_sort_by_value_then_relevance(value, reverse)
+            elif isinstance(sort_by, (list, tuple)):
                 sorter = MultiValueSorter()
                 for name in sort_by:
                     # If there is a problem, ignore this field
@@ -228,14 +604,23 @@ class SearchResults(object):
         else:
             enquire.set_sort_by_relevance()
 
-        # start/size
+        # start/size (the MSet is bounded by the number of matches, so
+        # there is no need to count them first)
         if size == 0:
-            size = self._max
+            size = catalog._get_doccount()
 
         # Construction of the results
-        fields = catalog._fields
-        results = [ Doc(x.document, fields, metadata)
-                    for x in enquire.get_mset(start, size) ]
+        t0 = time()
+        mset = enquire.get_mset(start, size)
+        t1 = time()
+        if fields is None:
+            fields = catalog._fields
+            results = [ Doc(x.document, fields, metadata) for x in mset ]
+        else:
+            make_row = _make_projection(catalog._fields, metadata, fields)
+            results = [ make_row(x.document) for x in mset ]
+        self._record(_get_sort_mode(sort_by, reverse), t0, t1, len(results),
+                     time())
 
         # sort_by=None/reverse=True
         if sort_by is None and reverse:
@@ -244,33 +629,272 @@ class SearchResults(object):
         return results
 
 
+    def search_after(self, cursor=None, size=20, sort_by=None, reverse=False,
+                     fields=None):
+        """Returns the next page of documents, and the cursor to ask for the
+        page after it (None if this is the last page):
+
+          docs, cursor = results.search_after(cursor, size, sort_by='abspath')
+
+        Unlike "get_documents(start=..., size=...)", the cost does not grow
+        with the page number: the cursor is an opaque token that keeps the
+        sort value of the last document returned, and the next page is found
+        with a value range restriction.  Every page costs a match of at most
+        "size + 2" documents (plus the cost of the range restriction, which
+        is proportional to the number of documents after the cursor).
+
+        For this the sort value must be unique: the results must be sorted
+        by "abspath", or by a sort profile that ends with "abspath".  The
+        same "sort_by" and "reverse" must be passed for every page.
+        """
+        catalog = self._database.catalog
+        metadata = catalog._metadata
+        if sort_by == 'abspath':
+            slot = metadata['abspath']['value']
+        else:
+            slot = None
+            if sort_by is not None:
+                slot = catalog._get_sort_value(sort_by)
+            if slot is not None:
+                if type(sort_by) is str:
+                    names = metadata['sort:%s' % sort_by]['sort']
+                else:
+                    names = list(sort_by)
+                if names[-1] != 'abspath':
+                    slot = None
+            if slot is None:
+                error = ('search_after requires a unique sort: "abspath", or '
+                         'a sort profile ending with "abspath", not "%s"')
+                raise ValueError, error % (sort_by,)
+
+        # Restrict the query to the documents after the cursor
+        xquery = self._xquery
+        last_value = None
+        if cursor is not None:
+            last_value = _decode_cursor(cursor)
+            op = OP_VALUE_LE if reverse else OP_VALUE_GE
+            xquery = Query(OP_AND, [xquery, Query(op, slot, last_value)])
+
+        enquire = self._get_enquire(xquery)
+        enquire.set_sort_by_value(slot, reverse)
+
+        # Match: the last document returned comes first.  One more document
+        # is asked to know whether there is a next page.
+        t0 = time()
+        mset = enquire.get_mset(0, size + 2)
+        t1 = time()
+        items = []
+        for x in mset:
+            xdoc = x.document
+            value = xdoc.get_value(slot)
+            if value == last_value:
+                continue
+            items.append((value, xdoc))
+            if len(items) > size:
+                break
+
+        # The next cursor
+        next_cursor = None
+        if len(items) > size:
+            items.pop()
+            next_cursor = _encode_cursor(items[-1][0])
+
+        # Construction of the results
+        if fields is None:
+            fields = catalog._fields
+            results = [ Doc(x[1], fields, metadata) for x in items ]
+        else:
+            make_row = _make_projection(catalog._fields, metadata, fields)
+            results = [ make_row(x[1]) for x in items ]
+        self._record(_get_sort_mode(sort_by, reverse), t0, t1, len(results),
+                     time())
+        return results, next_cursor
+
+
     def get_resources(self, sort_by=None, reverse=False, start=0, size=0):
         database = self._database
-        for brain in self.get_documents(sort_by, reverse, start, size):
+        brains = self.get_documents(sort_by, reverse, start, size,
+                                    fields=['abspath'])
+        for brain in brains:
             yield database.get_resource(brain.abspath)
 
 
 
+class BulkIndexer(object):
+    """Indexes documents in bulk.  This is to be used as a context manager
+    (see Catalog.bulk), the metadata (the fields definition) is written only
+    once, when the indexer is flushed or closed.
+
+    The optional "flush_docs" and "flush_bytes" parameters define the number
+    of documents, or the number of bytes indexed, after which the changes
+    are written to disk.  Note that, in asynchronous mode, flushing commits
+    the current transaction, so it cannot be aborted anymore.
+    """
+
+    def __init__(self, catalog, flush_docs=None, flush_bytes=None):
+        self.catalog = catalog
+        self.flush_docs = flush_docs
+        self.flush_bytes = flush_bytes
+        # State
+        self.metadata_modified = False
+        self.pending_docs = 0
+        self.pending_bytes = 0
+        # Statistics
+        self.n_docs = 0
+        self.n_bytes = 0
+        self.n_flushes = 0
+        self.t0 = None
+        self.t1 = None
+
+
+    def __enter__(self):
+        self.t0 = time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Write the metadata, unless something went wrong
+        if exc_type is None:
+            self.close()
+        return False
+
+
+    def index_document(self, document):
+        catalog = self.catalog
+        xdoc, key, route, size, metadata_modified = catalog._make_xdoc(
+            document)
+        catalog._save_xdoc(xdoc, key, route)
+        if metadata_modified:
+            self.metadata_modified = True
+
+        # Update the state
+        self.pending_docs += 1
+        self.pending_bytes += size
+        self.n_docs += 1
+        self.n_bytes += size
+
+        # Flush ?
+        flush_docs = self.flush_docs
+        flush_bytes = self.flush_bytes
+        if flush_docs and self.pending_docs >= flush_docs:
+            self.flush()
+        elif flush_bytes and self.pending_bytes >= flush_bytes:
+            self.flush()
+
+
+    def write_metadata(self):
+        if self.metadata_modified:
+            catalog = self.catalog
+            catalog._set_metadata('metadata', dumps(catalog._metadata))
+            self.metadata_modified = False
+
+
+    def flush(self):
+        """Write the metadata and the documents indexed so far to disk.
+        """
+        self.write_metadata()
+        catalog = self.catalog
+        if catalog._asynchronous:
+            catalog.save_changes()
+        else:
+            catalog._flush()
+        self.pending_docs = 0
+        self.pending_bytes = 0
+        self.n_flushes += 1
+
+
+    def close(self):
+        """Write the metadata; the changes since the last flush are left to
+        be committed by Catalog.save_changes (or aborted).
+        """
+        self.write_metadata()
+        self.t1 = time()
+        stats = self.get_stats()
+        msg = 'indexed {docs} documents ({bytes} bytes) in {time:.2f}s: '
+        msg += '{docs_per_second:.1f} docs/s'
+        log_debug(msg.format(**stats), domain='itools.database')
+
+
+    def get_stats(self):
+        """Returns a dict with the number of documents and bytes indexed, the
+        number of flushes, the time spent, and the throughput.
+        """
+        t0 = self.t0
+        t1 = self.t1 if self.t1 is not None else time()
+        seconds = (t1 - t0) if t0 is not None else 0.0
+        return {
+            'docs': self.n_docs,
+            'bytes': self.n_bytes,
+            'flushes': self.n_flushes,
+            'time': seconds,
+            'docs_per_second': (self.n_docs / seconds) if seconds else 0.0,
+            'bytes_per_second': (self.n_bytes / seconds) if seconds else 0.0}
+
+
+
 class Catalog(object):
+    """The catalog is a Xapian database, or several Xapian databases (the
+    shards).  A sharded catalog is a folder with one sub-folder by shard,
+    named "shard-0", "shard-1", etc. (see make_catalog).
+
+    Every document is stored in the shard chosen by the "router" function,
+    from its abspath; the searches run over the union of the shards, and
+    only the shards that have changed are committed.
+    """
 
-    def __init__(self, ref, fields, read_only=False, asynchronous_mode=True):
-        # Load the database
+    # The maximum number of terms a wildcard expands to
+    max_expansion = 1000
+
+
+    def __init__(self, ref, fields, read_only=False, asynchronous_mode=True,
+                 sort_profiles=None, router=None):
+        # Load the database(s)
         if isinstance(ref, (Database, WritableDatabase)):
-            self._db = ref
+            shards = [ref]
+        elif type(ref) is list:
+            shards = ref
         else:
             path = lfs.get_absolute_path(ref)
+            paths = _get_shard_paths(path) or [path]
             if read_only:
-                self._db = Database(path)
+                shards = [ Database(x) for x in paths ]
             else:
-                self._db = WritableDatabase(path, DB_OPEN)
+                shards = [ WritableDatabase(x, DB_OPEN) for x in paths ]
+
+        # Sharded: the searches run over the union of the shards
+        if len(shards) == 1:
+            self._db = shards[0]
+        else:
+            self._db = Database()
+            for shard in shards:
+                self._db.add_database(shard)
+        self._shards = [] if read_only else shards
+        self._router = None
+        if len(self._shards) > 1:
+            self._router = _get_router(shards[0], router)
+        # The shards modified since the last commit
+        self._dirty = set()
 
-        db = self._db
         self._asynchronous = asynchronous_mode
         self._fields = fields
+        if sort_profiles is None:
+            sort_profiles = get_register_sort_profiles()
+        self._sort_profiles = sort_profiles
 
         # Asynchronous mode
         if not read_only and asynchronous_mode:
-            db.begin_transaction(False)
+            for shard in shards:
+                shard.begin_transaction(False)
+
+        # The overlay: the documents not yet indexed, by key term
+        self._overlay = {}
+        self._overlay_db = None
+        # The search cache
+        self.search_cache = SearchCache()
+        # The statistics of the searches
+        self.query_stats = QueryStats()
+        # The query parsers, by language
+        self._query_parsers = {}
 
         # Load the xfields from the database
         self._metadata = {}
@@ -287,10 +911,25 @@ class Catalog(object):
         """
         if not self._asynchronous:
             raise ValueError, "The transactions are synchronous"
-        db = self._db
-        db.commit_transaction()
-        db.flush()
-        db.begin_transaction(False)
+        # Only the shards that have changed.  The first one is the last, it
+        # keeps the metadata (e.g. the commit), so if something fails before
+        # the metadata is not saved.
+        for i in sorted(self._dirty, reverse=True):
+            shard = self._shards[i]
+            shard.commit_transaction()
+            shard.flush()
+            shard.begin_transaction(False)
+        self._dirty.clear()
+        self.search_cache.clear()
+
+
+    def reopen(self):
+        """Reopen the database, to see the latest changes committed by other
+        processes (for read-only catalogs).
+        """
+        self._db.reopen()
+        self._load_all_internal()
+        self.search_cache.clear()
 
 
     def abort_changes(self):
@@ -298,19 +937,155 @@ class Catalog(object):
         """
         if not self._asynchronous:
             raise ValueError, "The transactions are synchronous"
-        db = self._db
-        db.cancel_transaction()
+        shards = [ self._shards[i] for i in self._dirty ]
+        for shard in shards:
+            shard.cancel_transaction()
+        self._dirty.clear()
         self._load_all_internal()
-        db.begin_transaction(False)
+        for shard in shards:
+            shard.begin_transaction(False)
+        self.search_cache.clear()
 
 
     #######################################################################
     # API / Public / (Un)Index
     #######################################################################
     def index_document(self, document):
-        """Add a new document.
+        """Add a new document, or replace the document with the same key
+        field (abspath) if it is already indexed.
+        """
+        xdoc, key, route, size, metadata_modified = self._make_xdoc(document)
+
+        # Save the doc
+        self._save_xdoc(xdoc, key, route)
+
+        # Store metadata ?
+        if metadata_modified:
+            self._set_metadata('metadata', dumps(self._metadata))
+
+
+    def index_documents(self, documents, flush_docs=None, flush_bytes=None):
+        """Add the given documents, in bulk.  Returns the statistics of the
+        operation (see BulkIndexer.get_stats).
+        """
+        bulk = BulkIndexer(self, flush_docs, flush_bytes)
+        with bulk:
+            for document in documents:
+                bulk.index_document(document)
+        return bulk.get_stats()
+
+
+    def bulk(self, flush_docs=None, flush_bytes=None):
+        """Returns a bulk indexer, to be used as a context manager:
+
+          with catalog.bulk(flush_docs=10000) as bulk:
+              for document in documents:
+                  bulk.index_document(document)
+        """
+        return BulkIndexer(self, flush_docs, flush_bytes)
+
+
+    def unindex_document(self, abspath):
+        """Remove the document that has value stored in its abspath.
+           If the document does not exist => no error
+        """
+        route = _encode(self._fields['abspath'], abspath)
+        key = 'Q' + _reduce_size(route)
+        i = self._get_shard(route)
+        self._shards[i].delete_document(key)
+        self._dirty.add(i)
+        self.search_cache.clear()
+
+
+    #######################################################################
+    # API / Public / Overlay
+    #######################################################################
+    def overlay_index_document(self, document, seq):
+        """Makes the given document visible to the searches, without
+        indexing it: the overlay is kept in memory and takes precedence over
+        the database.  The "seq" number identifies the batch of changes the
+        document belongs to (see clear_overlay).
+
+        New fields are written to the database metadata, to be saved with
+        the next transaction.
+        """
+        xdoc, key, route, size, metadata_modified = self._make_xdoc(document)
+        if metadata_modified:
+            self._set_metadata('metadata', dumps(self._metadata))
+        xdoc.add_term(OVERLAY_TERM)
+        self._overlay[key] = (seq, xdoc)
+        self._overlay_db = None
+        self.search_cache.clear()
+
+
+    def overlay_unindex_document(self, abspath, seq):
+        """Hides the given document from the searches, without unindexing
+        it (see overlay_index_document).
+        """
+        key = 'Q' + _reduce_size(_encode(self._fields['abspath'], abspath))
+        self._overlay[key] = (seq, None)
+        self._overlay_db = None
+        self.search_cache.clear()
+
+
+    def clear_overlay(self, seq):
+        """Removes from the overlay the documents of the batches up to the
+        given "seq" number, once they have been indexed.
+        """
+        overlay = self._overlay
+        for key, value in overlay.items():
+            if value[0] <= seq:
+                del overlay[key]
+        self._overlay_db = None
+        self.search_cache.clear()
+
+
+    #######################################################################
+    # API / Public / Git
+    #######################################################################
+    def get_commit(self):
+        """Returns the SHA of the Git commit the catalog was last synchronized
+        with, or None if unknown.
+        """
+        return self._db.get_metadata('commit') or None
+
+
+    def set_commit(self, sha):
+        """Records the SHA of the Git commit the catalog is synchronized with,
+        it will be saved with the next transaction.
+        """
+        self._set_metadata('commit', sha)
+
+
+    #######################################################################
+    # API / Public / Search
+    #######################################################################
+    def get_unique_values(self, name):
+        """Return all the terms of a given indexed field
+        """
+        metadata = self._metadata
+        # If there is a problem => an empty result
+        if name not in metadata:
+            warn_not_indexed(name)
+            return set()
+
+        # Ok
+        prefix = metadata[name]['prefix']
+        prefix_len = len(prefix)
+        return set([ t.term[prefix_len:] for t in self._db.allterms(prefix) ])
+
+
+    #######################################################################
+    # API / Private
+    #######################################################################
+    def _make_xdoc(self, document):
+        """Build the Xapian document for the given document (a dict or a
+        resource).  Returns a tuple with five values: the Xapian document,
+        its unique key term (None if there is not the key field), the
+        encoded abspath the shard is chosen from (see _get_shard), the
+        approximate size in bytes of the data indexed and stored, and
+        whether the metadata has been modified (new fields).
         """
-        db = self._db
         metadata = self._metadata
         fields = self._fields
 
@@ -322,6 +1097,8 @@ class Catalog(object):
 
         # Make the xapian document
         metadata_modified = False
+        key = route = None
+        size = 0
         xdoc = Document()
         for name, value in doc_values.iteritems():
             if name not in fields:
@@ -343,8 +1120,9 @@ class Catalog(object):
             #          two => to index without split
             #          the problem is that "_encode != _index"
             if name == 'abspath':
-                key_value = _reduce_size(_encode(field_cls, value))
-                xdoc.add_term('Q' + key_value)
+                route = _encode(field_cls, value)
+                key = 'Q' + _reduce_size(route)
+                xdoc.add_term(key)
 
             # A multilingual value?
             if isinstance(value, dict):
@@ -364,10 +1142,12 @@ class Catalog(object):
                     if lang_value is not None:
                         # Is stored ?
                         if 'value' in lang_info:
-                            xdoc.add_value(lang_info['value'],
-                                           _encode(field_cls, lang_value))
+                            data = _encode(field_cls, lang_value)
+                            xdoc.add_value(lang_info['value'], data)
+                            size += len(data)
                         # Is indexed ?
                         if 'prefix' in lang_info:
+                            size += 2 * _get_size(lang_value)
                             # Comment: Index twice
                             _index(xdoc, field_cls, lang_value,
                                    info['prefix'], language)
@@ -377,51 +1157,105 @@ class Catalog(object):
             elif value is not None:
                 # Is stored ?
                 if 'value' in info:
-                    xdoc.add_value(info['value'], _encode(field_cls, value))
+                    data = _encode(field_cls, value)
+                    xdoc.add_value(info['value'], data)
+                    size += len(data)
                 # Is indexed ?
                 if 'prefix' in info:
+                    size += _get_size(value)
                     # By default language='en'
                     _index(xdoc, field_cls, value, info['prefix'], 'en')
 
-        # TODO: Don't store two documents with the same key field!
+        # Sort profiles: the composite sort keys, computed from the values
+        # stored above
+        for name, names in self._sort_profiles.iteritems():
+            info = metadata.get('sort:%s' % name)
+            if info is None:
+                info = self._get_sort_info(name)
+                metadata_modified = True
+            sort_key = _make_sort_key(xdoc, metadata, names)
+            if sort_key:
+                xdoc.add_value(info['value'], sort_key)
 
-        # Save the doc
-        db.add_document(xdoc)
+        return xdoc, key, route, size, metadata_modified
 
-        # Store metadata ?
-        if metadata_modified:
-            db.set_metadata('metadata', dumps(metadata))
 
+    def _save_xdoc(self, xdoc, key, route):
+        """Store the given Xapian document.  There is at most one document
+        by key: if there is already one, it is replaced.
+        """
+        i = self._get_shard(route)
+        shard = self._shards[i]
+        if key is None:
+            shard.add_document(xdoc)
+        else:
+            shard.replace_document(key, xdoc)
+        self._dirty.add(i)
+        self.search_cache.clear()
 
-    def unindex_document(self, abspath):
-        """Remove the document that has value stored in its abspath.
-           If the document does not exist => no error
+
+    def _get_enquire(self, xquery):
+        """Returns the Enquire object for the given query.  If there are
+        documents in the overlay, the search runs over the database and an
+        in-memory database with the overlay, but the documents of the
+        database that are in the overlay are left out.
         """
-        data = _reduce_size(_encode(self._fields['abspath'], abspath))
-        self._db.delete_document('Q' + data)
+        overlay = self._overlay
+        if not overlay:
+            enquire = Enquire(self._db)
+            enquire.set_query(xquery)
+            return enquire
+
+        db = self._overlay_db
+        if db is None:
+            overlay_db = inmemory_open()
+            for seq, xdoc in overlay.itervalues():
+                if xdoc is not None:
+                    overlay_db.add_document(xdoc)
+            db = Database()
+            db.add_database(self._db)
+            db.add_database(overlay_db)
+            self._overlay_db = db
+
+        keys = Query(OP_OR, list(overlay))
+        in_db = Query(OP_AND_NOT, [xquery, keys])
+        in_overlay = Query(OP_FILTER, [xquery, Query(OVERLAY_TERM)])
+        enquire = Enquire(db)
+        enquire.set_query(Query(OP_OR, [in_db, in_overlay]))
+        return enquire
 
 
-    #######################################################################
-    # API / Public / Search
-    #######################################################################
-    def get_unique_values(self, name):
-        """Return all the terms of a given indexed field
+    def _get_doccount(self):
+        return self._db.get_doccount() + len(self._overlay)
+
+
+    def _get_shard(self, route):
+        """Returns the number of the shard where the document with the given
+        abspath (encoded) is (or will be) stored.
         """
-        metadata = self._metadata
-        # If there is a problem => an empty result
-        if name not in metadata:
-            warn_not_indexed(name)
-            return set()
+        n = len(self._shards)
+        if n == 1 or route is None:
+            return 0
+        return self._router(route, n)
 
-        # Ok
-        prefix = metadata[name]['prefix']
-        prefix_len = len(prefix)
-        return set([ t.term[prefix_len:] for t in self._db.allterms(prefix) ])
+
+    def _set_metadata(self, name, value):
+        """The metadata is kept by the first shard (this is the one Xapian
+        reads it from, when searching over several databases).
+        """
+        self._shards[0].set_metadata(name, value)
+        self._dirty.add(0)
+
+
+    def _flush(self):
+        """Writes to disk the shards that have changed (synchronous mode).
+        The first shard, which keeps the metadata, is the last one.
+        """
+        for i in sorted(self._dirty, reverse=True):
+            self._shards[i].flush()
+        self._dirty.clear()
 
 
-    #######################################################################
-    # API / Private
-    #######################################################################
     def _get_info(self, field_cls, name):
         # The key field ?
         if name == 'abspath':
@@ -443,6 +1277,67 @@ class Catalog(object):
         return info
 
 
+    def _get_sort_info(self, name):
+        """Defines the value slot for the given sort profile.  If there are
+        documents already, they do not have the sort key until they are
+        reindexed: a warning is logged.
+        """
+        if self._get_doccount() > 0:
+            msg = ('the sort profile "%s" is new, the catalog must be '
+                   'reindexed to sort the old documents correctly')
+            log_warning(msg % name, domain='itools.database')
+
+        info = {'value': self._value_nb,
+                'sort': list(self._sort_profiles[name])}
+        self._value_nb += 1
+        self._metadata['sort:%s' % name] = info
+        return info
+
+
+    def _get_sort_value(self, sort_by):
+        """Returns the value slot of the sort profile that matches the given
+        list of fields (or the given profile name), or None if there is not
+        any.  Only the sort profiles known by the catalog metadata are
+        considered (documents indexed before the profile was registered do
+        not have the sort key).
+        """
+        metadata = self._metadata
+        if type(sort_by) is str:
+            info = metadata.get('sort:%s' % sort_by)
+            return info['value'] if info else None
+
+        sort_by = list(sort_by)
+        for name, names in self._sort_profiles.iteritems():
+            if list(names) == sort_by:
+                info = metadata.get('sort:%s' % name)
+                return info['value'] if info else None
+        return None
+
+
+    def _get_query_parser(self, language):
+        """Returns the query parser for the given language, they are cached
+        by the catalog since they are bound to the database.
+        """
+        qp = self._query_parsers.get(language)
+        if qp is None:
+            qp = QueryParser()
+            qp.set_database(self._db)
+            stemmer = get_analyzer(language).stemmer
+            if stemmer is not None:
+                qp.set_stemmer(stemmer)
+                qp.set_stemming_strategy(QueryParser.STEM_SOME)
+            # Bound the expansion of the wildcards
+            limit = self.max_expansion
+            if hasattr(qp, 'set_max_expansion'):
+                # Xapian >= 1.4: keep the most frequent terms
+                qp.set_max_expansion(limit, WILDCARD_LIMIT_MOST_FREQUENT)
+            elif hasattr(qp, 'set_max_wildcard_expansion'):
+                # Before: WildcardError if the limit is exceeded
+                qp.set_max_wildcard_expansion(limit)
+            self._query_parsers[language] = qp
+        return qp
+
+
     def _load_all_internal(self):
         """Load the metadata from the database
         """
@@ -601,11 +1496,18 @@ class Catalog(object):
             value = query.value
             if type(value) is not unicode:
                 raise TypeError, "unexpected %s for 'value'" % type(value)
-            value = value.translate(TRANSLATE_MAP)
+            value = value.translate(FOLD_TABLE)
 
-            qp = QueryParser()
-            qp.set_database(self._db)
-            return qp.parse_query(_encode(field_cls, value), TQ_FLAGS, prefix)
+            qp = self._get_query_parser('en')
+            value = _encode(field_cls, value)
+            try:
+                return qp.parse_query(value, TQ_FLAGS, prefix)
+            except WildcardError:
+                # Too many terms, search without the wildcards
+                log_warning('too many terms for "%s"' % value,
+                            domain='itools.database')
+                flags = TQ_FLAGS & ~QueryParser.FLAG_WILDCARD
+                return qp.parse_query(value, flags, prefix)
 
         i2x = self._query2xquery
         # Multiple query with single atom
@@ -626,7 +1528,7 @@ class Catalog(object):
 
 
 
-def make_catalog(uri, fields):
+def make_catalog(uri, fields, shards=None, router=None):
     """Creates a new and empty catalog in the given uri.
 
     fields must be a dict. It contains some informations about the
@@ -636,10 +1538,62 @@ def make_catalog(uri, fields):
 
       fields = {'abspath': String(stored=True, indexed=True),
                 'name': Unicode(indexed=True), ...}
+
+    If "shards" is given, the catalog is split in that number of Xapian
+    databases, the documents are distributed by the "router" function (by
+    default shard_by_hash).  The router must be registered (see
+    register_shard_router), its name is stored in the catalog so it is used
+    every time the catalog is opened.
     """
     path = lfs.get_absolute_path(uri)
-    db = WritableDatabase(path, DB_CREATE)
-    return Catalog(db, fields)
+    if not shards:
+        db = WritableDatabase(path, DB_CREATE)
+        return Catalog(db, fields)
+
+    if router is None:
+        router = shard_by_hash
+    name = router.__name__
+    if shard_routers.get(name) is not router:
+        raise ValueError, 'the shard router "%s" is not registered' % name
+
+    lfs.make_folder(path)
+    dbs = [ WritableDatabase('%s/shard-%d' % (path, i), DB_CREATE)
+            for i in range(shards) ]
+    dbs[0].set_metadata('router', name)
+    dbs[0].flush()
+    return Catalog(dbs, fields)
+
+
+
+def shard_by_hash(abspath, n):
+    """Routes the documents to the shards by a hash of their abspath.
+    """
+    return crc32(abspath) % n
+
+
+
+def shard_by_prefix(abspath, n):
+    """Routes the documents to the shards by the first level of their
+    abspath, so a folder and its content are in the same shard.
+    """
+    prefix = abspath.lstrip('/').split('/', 1)[0]
+    return crc32(prefix) % n
+
+
+
+# The shard routers, by name (see make_catalog)
+shard_routers = {}
+
+
+def register_shard_router(router):
+    """Registers the given router function, to be used by sharded
+    catalogs.  Its name is stored by the catalog, so it must be unique.
+    """
+    shard_routers[router.__name__] = router
+
+
+register_shard_router(shard_by_hash)
+register_shard_router(shard_by_prefix)
 
 
 
@@ -647,6 +1601,33 @@ def make_catalog(uri, fields):
 # Private API
 
 
+def _get_router(db, router=None):
+    """Returns the router of the sharded catalog, from its name stored in
+    the given database (the first shard).  If a router is given it must be
+    the same.
+    """
+    name = db.get_metadata('router') or 'shard_by_hash'
+    stored = shard_routers.get(name)
+    if stored is None:
+        raise ValueError, 'unknown shard router "%s"' % name
+    if router is not None and router is not stored:
+        raise ValueError, 'the catalog uses the shard router "%s"' % name
+    return stored
+
+
+
+def _get_shard_paths(path):
+    """Returns the paths of the shards of the catalog in the given path, or
+    an empty list if the catalog is not sharded.
+    """
+    if not lfs.exists(path):
+        return []
+    names = [ x for x in lfs.get_names(path) if x.startswith('shard-') ]
+    names.sort(key=lambda x: int(x[6:]))
+    return [ '%s/%s' % (path, x) for x in names ]
+
+
+
 def _get_prefix(number):
     """By convention:
     Q is used for the unique Id of a document
@@ -713,11 +1694,116 @@ def _encode(field_cls, value):
 
 
 
+def _make_sort_key(xdoc, metadata, names):
+    """Builds the composite sort key for the given fields, from the values
+    stored in the given Xapian document.  The values are escaped and
+    concatenated in a way that the keys sort like the tuples of values:
+    every '\x00' is replaced by '\x00\xff', and the values are separated
+    by '\x00\x00' (like Xapian's MultiValueKeyMaker does).
+    """
+    values = []
+    for name in names:
+        info = metadata.get(name)
+        if info is None or 'value' not in info:
+            values.append('')
+        else:
+            value = xdoc.get_value(info['value'])
+            values.append(value.replace('\x00', '\x00\xff'))
+
+    key = '\x00\x00'.join(values)
+    return key.rstrip('\x00')
+
+
+
+def _encode_cursor(value):
+    """Returns the opaque token for a search_after cursor.
+    """
+    return urlsafe_b64encode(value)
+
+
+
+def _decode_cursor(cursor):
+    try:
+        return urlsafe_b64decode(cursor)
+    except (ValueError, TypeError):
+        raise ValueError, 'bad cursor "%s"' % cursor
+
+
+
 def _get_field_cls(name, fields, info):
     return fields[name] if (name in fields) else fields[info['from']]
 
 
 
+_row_classes = {}
+
+def _make_projection(fields, metadata, names):
+    """Returns a function that, given a Xapian document, returns a row (a
+    named tuple) with the decoded values of the given stored fields.
+
+    Everything that does not depend on the document is computed here, once:
+    the value slots, the field classes, and the value slots of the
+    languages of the multilingual fields.
+    """
+    names = tuple(names)
+    row_cls = _row_classes.get(names)
+    if row_cls is None:
+        row_cls = _row_classes[names] = namedtuple('Row', names)
+
+    columns = []
+    for name in names:
+        info = metadata.get(name)
+        if info is None:
+            raise ValueError, MSG_NOT_INDEXED_NOR_STORED.format(name=name)
+        slot = info.get('value')
+        if slot is None:
+            raise ValueError, MSG_NOT_STORED.format(name=name)
+        field_cls = _get_field_cls(name, fields, info)
+
+        # Multilingual field (language negotiation)
+        languages = []
+        if issubclass(field_cls, Unicode) and 'from' not in info:
+            prefix = '%s_' % name
+            n = len(prefix)
+            for k, lang_info in metadata.iteritems():
+                if k[:n] == prefix and 'value' in lang_info:
+                    languages.append((k[n:], lang_info['value']))
+
+        columns.append((slot, field_cls, languages))
+
+    def make_row(xdoc):
+        row = []
+        for slot, field_cls, languages in columns:
+            raw_value = xdoc.get_value(slot)
+            if raw_value:
+                row.append(_decode(field_cls, raw_value))
+                continue
+
+            if languages:
+                values = {}
+                for language, lang_slot in languages:
+                    raw_value = xdoc.get_value(lang_slot)
+                    if raw_value:
+                        value = _decode(field_cls, raw_value)
+                        if not field_cls.is_empty(value):
+                            values[language] = value
+                if values:
+                    language = select_language(values.keys())
+                    if language is None:
+                        language = values.keys()[0]
+                    row.append(values[language])
+                    continue
+
+            # FIXME Xapian does not make the difference between the empty
+            # string and the absence of value (None).
+            row.append(field_cls.get_default())
+
+        return row_cls(*row)
+
+    return make_row
+
+
+
 def _reduce_size(data):
     # 'data' must be a byte string
 
@@ -732,51 +1818,49 @@ def _reduce_size(data):
 
 
 
-def _index_cjk(xdoc, value, prefix, termpos):
+def _get_size(value):
+    """Returns the approximate size in bytes of the given value, as it is
+    indexed.  Used to decide when to flush in bulk mode.
     """
-    Returns the next word and its position in the data. The analysis
-    is done with the automaton:
-
-    0 -> 1 [letter or number or cjk]
-    0 -> 0 [stop word]
-    1 -> 0 [stop word]
-    1 -> 2 [letter or number or cjk]
-    2 -> 2 [letter or number or cjk]
-    2 -> 0 [stop word]
+    value_type = type(value)
+    if value_type is str or value_type is unicode:
+        return len(value)
+    if value_type in (list, tuple, set, frozenset):
+        return sum([ _get_size(x) for x in value ])
+    return 8
+
+
+
+def _index_cjk(xdoc, value, prefix, termpos):
+    """Indexes the given text by bigrams: every word (a sequence of
+    characters that are not punctuation) is split in pairs of consecutive
+    characters, words of one character are indexed as they are.
+
+    Returns the next term position.
     """
-    state = 0
-    previous_cjk = u''
-
-    for c in value:
-        if is_punctuation(c):
-            # Stop word
-            if previous_cjk and state == 1: # CJK not yielded yet
-                xdoc.add_posting(prefix + previous_cjk, termpos)
-                termpos += 1
-            # reset state
-            previous_cjk = u''
-            state = 0
+    add_posting = xdoc.add_posting
+    single = False
+    for word in split_punctuation(value.lower()):
+        n = len(word)
+        if n == 1:
+            add_posting(prefix + word, termpos)
+            termpos += 1
+            single = True
         else:
-            c = c.lower()
-            if previous_cjk:
-                xdoc.add_posting(prefix + (u'%s%s' % (previous_cjk, c)),
-                                 termpos)
+            for i in xrange(n - 1):
+                add_posting(prefix + word[i:i+2], termpos)
                 termpos += 1
-                state = 2
-            else:
-                state = 1
-            previous_cjk = c
-
-    # Last word
-    if previous_cjk and state == 1:
-        xdoc.add_posting(prefix + previous_cjk, termpos)
+            single = False
 
+    # The position after a single character ending the text is not
+    # incremented twice
+    if single and not is_punctuation(value[-1]):
+        return termpos
     return termpos + 1
 
 
 
-def _index_unicode(xdoc, value, prefix, language, termpos,
-                   TRANSLATE_MAP=TRANSLATE_MAP):
+def _index_unicode(xdoc, value, prefix, language, termpos):
     # Check type
     if type(value) is not unicode:
         msg = 'The value "%s", field "%s", is not a unicode'
@@ -787,17 +1871,7 @@ def _index_unicode(xdoc, value, prefix, language, termpos,
         return _index_cjk(xdoc, value, prefix, termpos)
 
     # Case 2: Any other language
-    tg = TermGenerator()
-    tg.set_document(xdoc)
-    tg.set_termpos(termpos - 1)
-    # Suppress the accents (FIXME This should be done by the stemmer)
-    value = value.translate(TRANSLATE_MAP)
-    # XXX With the stemmer, the words are saved twice:
-    # with prefix and with Zprefix
-#    tg.set_stemmer(stemmer)
-
-    tg.index_text(value, 1, prefix)
-    return tg.get_termpos() + 1
+    return get_analyzer(language).index_text(xdoc, value, prefix, termpos)
 
 
 
@@ -854,6 +1928,46 @@ def _make_PhraseQuery(field_cls, value, prefix):
 
 
 
+def _get_query_key(query=None, kw=None):
+    """Returns the key for the search cache from the given query or keyword
+    parameters (see _get_xquery).
+    """
+    if query is not None:
+        return repr(query)
+    if kw:
+        return repr(sorted(kw.items()))
+    return ''
+
+
+
+def _format_query(queries):
+    """Returns the given itools queries (see SearchResults) as a string,
+    for the logs.
+    """
+    lines = []
+    for query in queries:
+        if isinstance(query, dict):
+            if query:
+                lines.append(repr(sorted(query.items())))
+        else:
+            stream = StringIO()
+            pprint_query(query, stream=stream)
+            lines.append(stream.getvalue().rstrip())
+    return '\n'.join(lines) or '<everything>'
+
+
+
+def _get_sort_mode(sort_by, reverse):
+    """Returns the sort mode as a string, for the statistics.
+    """
+    if sort_by is None:
+        return 'relevance'
+    if type(sort_by) is not str:
+        sort_by = ','.join(sort_by)
+    return '%s (reverse)' % sort_by if reverse else sort_by
+
+
+
 def _get_xquery(catalog, query=None, **kw):
     # Case 1: a query is given
     if query is not None:
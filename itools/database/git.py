@@ -17,6 +17,7 @@
 # Import from the Standard Library
 from calendar import timegm
 from datetime import datetime
+from hashlib import sha1
 from os import listdir, makedirs, remove, rmdir, walk
 from os.path import abspath, dirname, exists, getmtime, isabs, isdir, isfile
 from os.path import normpath
@@ -28,9 +29,10 @@ import time
 # Import from pygit2
 from pygit2 import Repository, Signature, GitError, init_repository
 from pygit2 import GIT_SORT_REVERSE, GIT_SORT_TIME, GIT_OBJ_TREE
+from pygit2 import GIT_OBJ_BLOB
 
 # Import from itools
-from itools.core import lazy
+from itools.core import WeightedLRUCache, lazy
 
 
 def message_short(commit):
@@ -48,19 +50,59 @@ def message_short(commit):
     return message.rstrip()
 
 
+def get_blob_sha(data):
+    """Returns the SHA of the Git blob with the given contents, without
+    writing it to the object store.
+    """
+    sha = sha1('blob %d\x00' % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+
 def make_parent_dirs(path):
     folder = dirname(path)
     if not exists(folder):
         makedirs(folder)
 
 
+def get_object_size(obj):
+    """Returns the estimated size in memory, in bytes, of the given object:
+    a Git object, or a handler built from a blob.
+    """
+    get_cache_size = getattr(obj, 'get_cache_size', None)
+    if get_cache_size is not None:
+        return get_cache_size()
+
+    obj_type = obj.type
+    if obj_type == GIT_OBJ_BLOB:
+        return len(obj.data)
+    if obj_type == GIT_OBJ_TREE:
+        return 64 * len(obj)
+    return 512
+
+
+
+class ObjectCache(WeightedLRUCache):
+    """A cache of the objects read from the Git object store, bound by their
+    number ("length_max") and by their estimated size in memory, in bytes
+    ("size_max", see get_object_size).
+
+    The keys are the SHAs of the Git objects, or (sha, cls) for the handlers
+    built from blobs (see RODatabase.get_blob).
+    """
+
+    def __init__(self, length_max=10000, size_max=32 * 1024 * 1024):
+        super(ObjectCache, self).__init__(length_max, size_max,
+                                          get_object_size)
+
+
 
 class Worktree(object):
 
     def __init__(self, path, repo):
         self.path = abspath(path) + '/'
         self.repo = repo
-        self.cache = {} # {sha: object}
+        self.cache = ObjectCache()
         # FIXME These two fields are already available by libgit2. TODO
         # expose them through pygit2 and use them here.
         self.index_path = '%s/.git/index' % path
@@ -168,12 +210,17 @@ class Worktree(object):
         """Return the object by the given SHA. We use a cache to warrant that
         two calls with the same SHA will resolve to the same object, so the
         'is' operator will work.
+
+        The cache is bound (see ObjectCache), so this is only warranted for
+        the objects still in the cache: those recently used.
         """
         cache = self.cache
-        if sha not in cache:
-            cache[sha] = self.repo[sha]
+        obj = cache.get(sha)
+        if obj is None:
+            obj = self.repo[sha]
+            cache.set(sha, obj)
 
-        return cache[sha]
+        return obj
 
 
     def lookup_from_commit_by_path(self, commit, path):
@@ -249,17 +296,26 @@ class Worktree(object):
             abspath = self._get_abspath(path)
             # 1. File
             if isfile(abspath):
-                index.remove(path)
+                self._index_remove(index, path)
                 remove(abspath)
                 continue
             # 2. Folder
             for root, dirs, files in walk(abspath, topdown=False):
                 for name in files:
-                    index.remove('%s/%s' % (root[n:], name))
+                    self._index_remove(index, '%s/%s' % (root[n:], name))
                     remove('%s/%s' % (root, name))
                 rmdir(root)
 
 
+    def _index_remove(self, index, path):
+        # The file may be missing from the index if it was committed without
+        # it (see RWDatabase.direct_commit)
+        try:
+            index.remove(path)
+        except KeyError:
+            pass
+
+
     def git_mv(self, source, target, add=True):
         """Equivalent to 'git mv': moves the file or folder in the filesystem
         from 'source' to 'target', removes the source from the index file,
@@ -299,15 +355,20 @@ class Worktree(object):
         return self._call(cmd).rstrip()
 
 
-    def git_commit(self, message, author=None, date=None, tree=None):
+    def git_commit(self, message, author=None, date=None, tree=None,
+                   write_index=True):
         """Equivalent to 'git commit', we must give the message and we can
         also give the author and date.
+
+        If the tree is given and 'write_index' is False the index file is
+        not touched.
         """
         # TODO Check the 'nothing to commit' case
 
         # Write index
-        self.index.write()
-        self.index_mtime = getmtime(self.index_path)
+        if tree is None or write_index:
+            self.index.write()
+            self.index_mtime = getmtime(self.index_path)
 
         # Tree
         if tree is None:
@@ -394,8 +455,12 @@ class Worktree(object):
                         if a:
                             break
                     else:
+                        # Compare the SHAs, the objects may not be the same
+                        # (see lookup)
                         b = self.lookup_from_commit_by_path(parent, path)
-                        if a is not b:
+                        a = a.hex if a else None
+                        b = b.hex if b else None
+                        if a != b:
                             break
                 else:
                     continue
@@ -457,7 +522,8 @@ class Worktree(object):
         TODO Implement with libgit2
         """
         expr = '%s..%s' % (since, until)
-        cmd = ['git', 'show', '--numstat', '--pretty=format:', expr]
+        cmd = ['git', 'show', '--numstat', '--no-renames', '--pretty=format:',
+               expr]
         data = self._call(cmd)
         lines = data.splitlines()
         return frozenset([ line.split('\t')[-1] for line in lines if line ])
@@ -15,14 +15,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from cPickle import dump, dumps, load, loads, HIGHEST_PROTOCOL
+from cPickle import PicklingError
+from os import rename
+from os.path import exists
+
 # Import from itools
-from itools.core import add_type, freeze
+from itools.core import WeightedLRUCache, add_type, freeze
 from itools.csv import parse_table, Property, property_to_str
-from itools.csv import deserialize_parameters
+from itools.csv import deserialize_parameters, fold_line
+from itools.csv.table import unfold_lines, read_name, get_tokens
 from itools.datatypes import String
 from itools.handlers import File, register_handler_class
 from itools.log import log_warning
 from fields import Field
+from git import get_blob_sha
 
 
 
@@ -36,16 +44,92 @@ class DefaultField(Field):
 
 
 
+class MetadataCache(WeightedLRUCache):
+    """A cache of the parsed metadata files, from the SHA of the Git blob
+    (computed from the file contents) to a snapshot of the state of the
+    handler (format, version and raw properties).
+
+    The snapshots are pickled, so every handler gets its own copy, and the
+    cache is bound by their total size in bytes ("size_max").  They keep the
+    raw values of the properties, which are decoded when read (see
+    Metadata._decode_property): the cache saves the parsing of the file.
+
+    If a "path" is given the cache is loaded from that file, and written to
+    it by 'save', so it survives restarts.  The structure of the files is
+    checked against the resource classes when parsed, the file should be
+    removed if their fields change.
+    """
+
+    def __init__(self, size_max=16 * 1024 * 1024, path=None):
+        super(MetadataCache, self).__init__(weight_max=size_max,
+                                            get_weight=len)
+        self.path = path
+        self.changed = False
+        if path is not None and exists(path):
+            self.load()
+
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                items = load(file)
+        except Exception:
+            log_warning('the metadata cache "%s" could not be read'
+                        % self.path, domain='itools.database')
+            return
+
+        # From the least-recently used
+        set_snapshot = super(MetadataCache, self).set
+        for sha, snapshot in items:
+            set_snapshot(sha, snapshot)
+
+
+    def save(self):
+        """Writes the snapshots to the file of the cache, if they have
+        changed since it was loaded.
+        """
+        if self.path is None or not self.changed:
+            return
+
+        items = [ (x, y[0]) for x, y in self.entries.iteritems() ]
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'wb') as file:
+            dump(items, file, HIGHEST_PROTOCOL)
+        rename(tmp, self.path)
+        self.changed = False
+
+
+    def get(self, sha):
+        snapshot = super(MetadataCache, self).get(sha)
+        if snapshot is None:
+            return None
+        return loads(snapshot)
+
+
+    def set(self, sha, state):
+        try:
+            snapshot = dumps(state, HIGHEST_PROTOCOL)
+        except (PicklingError, TypeError):
+            return
+        super(MetadataCache, self).set(sha, snapshot)
+        self.changed = True
+
+
+
 class Metadata(File):
 
     class_mimetypes = ['text/x-metadata']
     class_extension = 'metadata'
+    cache_size = 2048
 
 
     def reset(self):
         self.format = None
         self.version = None
-        self.properties = {}
+        # The properties are decoded the first time they are accessed, until
+        # then we keep the raw lines: {name: [(line, value, parameters)]}
+        self._properties = {}
+        self._raw_properties = {}
 
 
     def new(self, cls=None, format=None, version=None):
@@ -54,12 +138,30 @@ class Metadata(File):
 
 
     def _load_state_from_file(self, file):
-        properties = self.properties
         data = file.read()
-        parser = parse_table(data)
+
+        # The parsed metadata files are cached by the database, by blob SHA
+        cache = getattr(self.database, 'metadata_cache', None)
+        if cache is None:
+            self._load_state_from_data(data)
+            return
+
+        sha = get_blob_sha(data)
+        state = cache.get(sha)
+        if state is not None:
+            self.format, self.version, self._raw_properties = state
+            return
+
+        self._load_state_from_data(data)
+        cache.set(sha, (self.format, self.version, self._raw_properties))
+
+
+    def _load_state_from_data(self, data):
+        raw_properties = self._raw_properties
+        lines = unfold_lines(data)
 
         # Read the format & version
-        name, value, parameters = parser.next()
+        name, value, parameters = parse_table(lines.next()).next()
         if name != 'format':
             raise ValueError, 'unexpected "%s" property' % name
         if 'version' in parameters:
@@ -73,21 +175,52 @@ class Metadata(File):
         # Get the schema
         resource_class = self.database.get_resource_class(value)
 
-        # Parse
-        for name, value, parameters in parser:
+        # Parse (keep the raw values, see "_decode_property")
+        for line in lines:
+            name, rest = read_name(line)
             if name == 'format':
                 raise ValueError, 'unexpected "format" property'
+            value, parameters = get_tokens(rest)
 
-            # 1. Get the field
+            # Check the field
             field = resource_class.get_field(name)
             if field is None:
                 msg = 'unexpected field "%s"' % name
                 if resource_class.fields_soft:
                     log_warning(msg, domain='itools.database')
-                    field = DefaultField
                 else:
                     raise ValueError, msg
+            elif field.multilingual:
+                if field.multiple:
+                    error = 'property "%s" is both multilingual and multiple'
+                    raise ValueError, error % name
+                if 'lang' not in parameters:
+                    err = 'multilingual property "%s" is missing the language'
+                    raise ValueError, err % name
+
+            raw_properties.setdefault(name, []).append(
+                (line, value, parameters))
+
+
+    def _decode_property(self, name):
+        """Decode the raw values of the given property, if not done yet.
+
+        The structure of the properties is checked when the file is loaded,
+        but the parameters and the values are decoded here: a bad parameter
+        or value raises ValueError the first time the property is accessed.
+        """
+        raw = self._raw_properties.pop(name, None)
+        if raw is None:
+            return
+
+        properties = self._properties
+        resource_class = self.database.get_resource_class(self.format)
+        # 1. Get the field
+        field = resource_class.get_field(name)
+        if field is None:
+            field = DefaultField
 
+        for line, value, parameters in raw:
             # 2. Deserialize the parameters
             params_schema = field.parameters_schema
             params_default = field.parameters_schema_default
@@ -98,22 +231,14 @@ class Metadata(File):
                 msg = 'in class "{0}" property "{1}": {2}'
                 raise ValueError, msg.format(resource_class, name, e)
 
-            # 3. Get the datatype properties
-            if field.multiple and field.multilingual:
-                error = 'property "%s" is both multilingual and multiple'
-                raise ValueError, error % name
-
-            # 4. Build the property
+            # 3. Build the property
             datatype = field.datatype
             value = datatype.decode(value)
             property = Property(value, **parameters)
 
             # Case 1: Multilingual
             if field.multilingual:
-                language = parameters.get('lang')
-                if language is None:
-                    err = 'multilingual property "%s" is missing the language'
-                    raise ValueError, err % name
+                language = parameters['lang']
                 properties.setdefault(name, {})[language] = property
             # Case 2: multiple
             elif field.multiple:
@@ -123,6 +248,15 @@ class Metadata(File):
                 properties[name] = property
 
 
+    @property
+    def properties(self):
+        """All the properties, decoded.
+        """
+        for name in self._raw_properties.keys():
+            self._decode_property(name)
+        return self._properties
+
+
     def to_str(self):
         resource_class = self.database.get_resource_class(self.format)
 
@@ -131,14 +265,13 @@ class Metadata(File):
         else:
             lines = ['format;version=%s:%s\n' % (self.version, self.format)]
         # Properties are to be sorted by alphabetical order
-        properties = self.properties
-        names = properties.keys()
-        names.sort()
+        properties = self._properties
+        raw_properties = self._raw_properties
+        names = set(properties) | set(raw_properties)
+        names = sorted(names)
 
         # Properties
         for name in names:
-            property = properties[name]
-
             # Get the field
             field = resource_class.get_field(name)
             if field is None:
@@ -148,6 +281,15 @@ class Metadata(File):
                     continue
                 raise ValueError, msg
 
+            # Not decoded, so not changed: pass it through verbatim
+            raw = raw_properties.get(name)
+            if raw is not None:
+                lines += [
+                    fold_line(line + '\n') for line, value, x in raw if value ]
+                continue
+
+            property = properties[name]
+
             datatype = field.datatype
             params_schema = field.parameters_schema
             is_empty = datatype.is_empty
@@ -184,7 +326,8 @@ class Metadata(File):
         If it is a multiple property, return the list of properties.
         """
         # Return 'None' if the property is missing
-        property = self.properties.get(name)
+        self._decode_property(name)
+        property = self._properties.get(name)
         if not property:
             return None
 
@@ -216,17 +359,19 @@ class Metadata(File):
 
 
     def has_property(self, name, language=None):
-        if name not in self.properties:
+        if name not in self._properties and name not in self._raw_properties:
             return False
 
         if language is not None:
-            return language in self.properties[name]
+            self._decode_property(name)
+            return language in self._properties[name]
 
         return True
 
 
     def _set_property(self, name, value):
-        properties = self.properties
+        self._decode_property(name)
+        properties = self._properties
 
         # Case 1: Remove property
         if value is None:
@@ -268,9 +413,10 @@ class Metadata(File):
 
 
     def del_property(self, name):
-        if name in self.properties:
+        if self.has_property(name):
             self.set_changed()
-            del self.properties[name]
+            self._raw_properties.pop(name, None)
+            self._properties.pop(name, None)
 
 
 ###########################################################################
@@ -279,4 +425,3 @@ class Metadata(File):
 register_handler_class(Metadata)
 for mimetype in Metadata.class_mimetypes:
     add_type(mimetype, '.%s' % Metadata.class_extension)
-
@@ -47,3 +47,23 @@ def register_field(name, field_cls):
 
 def get_register_fields():
     return fields_registry
+
+
+
+sort_profiles_registry = {}
+
+def register_sort_profile(name, fields):
+    """Registers a sort profile: a list of stored fields for which the
+    catalog will precompute a composite sort key (see Resource.sort_profiles).
+    The documents already indexed do not have the key until the catalog is
+    reindexed.
+    """
+    fields = tuple(fields)
+    old = sort_profiles_registry.get(name)
+    if old is not None and old != fields:
+        raise ValueError, 'register conflict over the "%s" sort profile' % name
+    sort_profiles_registry[name] = fields
+
+
+def get_register_sort_profiles():
+    return sort_profiles_registry
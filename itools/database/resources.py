@@ -19,7 +19,7 @@ from itools.core import freeze, is_prototype
 
 # Import from itools.database
 from fields import Field
-from registry import register_field
+from registry import register_field, register_sort_profile
 from ro import RODatabase
 
 
@@ -44,6 +44,11 @@ class DBResourceMetaclass(type):
                     datatype = field.get_datatype()
                     register_field(name, datatype)
 
+        # Register the sort profiles in the catalog
+        if 'sort_profiles' in dict:
+            for name, names in dict['sort_profiles'].iteritems():
+                register_sort_profile(name, names)
+
         # Ok
         return cls
 
@@ -62,6 +67,13 @@ class Resource(object):
     #   soft = True : log a warning
     fields_soft = False
 
+    # The sort profiles, a mapping from name to a list of stored fields:
+    # the catalog precomputes a sort key for every profile, so sorting by
+    # these fields (sort_by=[...]) is as fast as sorting by one field.  The
+    # documents are given the sort key when indexed, so the catalog must be
+    # reindexed after a profile is added (see reindex_catalog).
+    sort_profiles = freeze({})
+
 
     @classmethod
     def get_field(self, name):
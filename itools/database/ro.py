@@ -19,21 +19,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from os import walk
+from os.path import isdir
 from sys import getrefcount
 
 # Import from other libraries
 from xapian import DatabaseError, DatabaseOpeningError
 
+# Import from gio
+from gio import File as GioFile
+from gio import FILE_MONITOR_EVENT_CHANGED, FILE_MONITOR_EVENT_CREATED
+from gio import FILE_MONITOR_EVENT_DELETED
+
 # Import from itools
 from itools.core import LRUCache, lazy
 from itools.fs import lfs
 from itools.handlers import Folder, get_handler_class_by_mimetype
 from itools.log import log_warning
 from itools.uri import Path
-from catalog import Catalog, _get_xquery, SearchResults
+from catalog import Catalog, SearchResults, _get_query_key, _get_xquery
 from git import open_worktree
 from magic_ import magic_from_file
-from metadata import Metadata
+from metadata import Metadata, MetadataCache
 from registry import get_register_fields
 
 
@@ -46,7 +53,15 @@ class ReadonlyError(StandardError):
 
 class RODatabase(object):
 
-    def __init__(self, path, size_min=4800, size_max=5200):
+    # In trusted mode the database folder is only changed through Git commits
+    # made by itools, so the handlers in the cache are validated once per
+    # transaction against the Git HEAD, instead of checking the filesystem
+    # on every access (see sync_cache)
+    trusted = False
+
+
+    def __init__(self, path, size_min=4800, size_max=5200, bytes_min=None,
+                 bytes_max=None):
         # 1. Keep the path
         if not lfs.is_folder(path):
             error = '"%s" should be a folder, but it is not' % path
@@ -67,11 +82,31 @@ class RODatabase(object):
         # 4. New interface to Git
         self.worktree = open_worktree(self.path_data)
 
-        # 5. A mapping from key to handler
+        # 5. A mapping from key to handler, bound by the number of handlers
+        # and, optionally, by their size in memory (see make_room)
         self.cache = LRUCache(size_min, size_max, automatic=False)
+        if bytes_max is not None and bytes_min is None:
+            bytes_min = bytes_max
+        self.cache_bytes_min = bytes_min
+        self.cache_bytes_max = bytes_max
+
+        # 6. The git cache, shared with the worktree (see ObjectCache)
+        self.git_cache = self.worktree.cache
+
+        # The parsed metadata files, by blob SHA (see save_metadata_cache)
+        path = '%s/metadata.cache' % self.path
+        self.metadata_cache = MetadataCache(path=path)
 
-        # 6. The git cache
-        self.git_cache = LRUCache(900, 1100)
+        # 7. Whether the catalog has been synchronized in this transaction
+        self.catalog_synced = False
+
+        # 8. Trusted mode: the Git HEAD the cache is synchronized with, and
+        # whether it has been checked in this transaction
+        self.cache_head = None
+        self.cache_synced = False
+
+        # 9. The file monitors, by folder, when the database is watched
+        self.monitors = None
 
 
     #######################################################################
@@ -90,6 +125,25 @@ class RODatabase(object):
         if handler is None:
             return None
 
+        # Watched, the cache is synchronized by the file monitors
+        if self.monitors is not None:
+            return handler
+
+        # Trusted mode
+        if self.trusted:
+            if not self.cache_synced:
+                self.sync_cache()
+                # The handler may have been discarded
+                handler = self.cache.get(key)
+            return handler
+
+        return self._check_filesystem(key, handler)
+
+
+    def _check_filesystem(self, key, handler):
+        """Checks the given handler from the cache against the filesystem
+        (see _sync_filesystem).
+        """
         # (1) Not yet loaded
         if handler.timestamp is None and handler.dirty is None:
             # Removed from the filesystem
@@ -148,6 +202,42 @@ class RODatabase(object):
         handler.__dict__.clear()
 
 
+    def _watch_folder(self, path):
+        monitor = GioFile(path).monitor_directory()
+        monitor.connect('changed', self._on_file_changed)
+        self.monitors[path] = monitor
+
+
+    def _on_file_changed(self, monitor, file, other_file, event):
+        path = file.get_path()
+        key = path[len(self.path_data):]
+        if key == '.git':
+            return
+
+        if event == FILE_MONITOR_EVENT_CHANGED:
+            pass
+        elif event == FILE_MONITOR_EVENT_CREATED:
+            if isdir(path) and path not in self.monitors:
+                self._watch_folder(path)
+        elif event == FILE_MONITOR_EVENT_DELETED:
+            monitor = self.monitors.pop(path, None)
+            if monitor is not None:
+                monitor.cancel()
+        else:
+            return
+
+        # Discard the handler, unless it has been changed in this process
+        handler = self.cache.get(key)
+        if handler is None or handler.dirty is not None:
+            return
+        # Our own writes (the file has not changed since it was loaded)
+        timestamp = handler.timestamp
+        if timestamp is not None and self.fs.exists(key):
+            if self.fs.get_mtime(key) <= timestamp:
+                return
+        self._discard_handler(key)
+
+
     def _abort_changes(self):
         """To be called to abandon the transaction.
         """
@@ -193,21 +283,49 @@ class RODatabase(object):
         self.cache[key] = handler
 
 
+    def get_cache_size(self):
+        """Returns the estimated size in memory, in bytes, of the handlers in
+        the cache (see File.get_cache_size).
+        """
+        return sum([ x.get_cache_size() for x in self.cache.itervalues() ])
+
+
+    def save_metadata_cache(self):
+        """Writes the cache of the parsed metadata files to disk, it will be
+        loaded the next time the database is opened.  To be called before
+        the process exits.
+        """
+        self.metadata_cache.save()
+
+
     def make_room(self):
-        """Remove handlers from the cache until it fits the defined size.
+        """Remove handlers from the cache until it fits the defined size: the
+        number of handlers, and their size in memory if the database was
+        created with "bytes_max".
 
         Use with caution. If the handlers we are about to discard are still
         used outside the database, and one of them (or more) are modified, then
         there will be an error.
         """
         # Find out how many handlers should be removed
-        size = len(self.cache)
-        if size < self.cache.size_max:
+        cache = self.cache
+        size = len(cache)
+        n = (size - cache.size_min) if size >= cache.size_max else 0
+
+        # Find out how many bytes should be freed
+        n_bytes = 0
+        if self.cache_bytes_max is not None:
+            n_bytes = self.get_cache_size()
+            if n_bytes > self.cache_bytes_max:
+                n_bytes -= self.cache_bytes_min
+            else:
+                n_bytes = 0
+
+        if n <= 0 and n_bytes <= 0:
             return
 
         # Discard as many handlers as needed
-        n = size - self.cache.size_min
-        for key, handler in self.cache.iteritems():
+        for key, handler in cache.iteritems():
             # Skip externally referenced handlers (refcount should be 3:
             # one for the cache, one for the local variable and one for
             # the argument passed to getrefcount).
@@ -218,13 +336,48 @@ class RODatabase(object):
             if handler.dirty is not None:
                 continue
             # Discard this handler
+            n_bytes -= handler.get_cache_size()
             self._discard_handler(key)
             # Check whether we are done
             n -= 1
-            if n == 0:
+            if n <= 0 and n_bytes <= 0:
                 return
 
 
+    def watch(self):
+        """Watches the database folder (except '.git') for changes, made by
+        this process or by any other (rsync, a Git checkout, etc.), and
+        discards from the cache the handlers of the files changed.  Then
+        the cache hits do not check the filesystem.
+
+        The file monitors (inotify on Linux) are dispatched by the main
+        loop, so this is only useful with the main loop running.  There is
+        one monitor by folder, mind the inotify limits of the system
+        (fs.inotify.max_user_watches).
+        """
+        if self.monitors is not None:
+            return
+
+        self.monitors = {}
+        path_data = self.path_data
+        for folder, folders, files in walk(path_data):
+            if folder == path_data and '.git' in folders:
+                folders.remove('.git')
+            self._watch_folder(folder)
+
+
+    def unwatch(self):
+        """Stops watching the database folder (see watch).
+        """
+        monitors = self.monitors
+        if monitors is None:
+            return
+
+        self.monitors = None
+        for monitor in monitors.itervalues():
+            monitor.cancel()
+
+
     def has_handler(self, key):
         key = self.normalize_key(key)
 
@@ -290,6 +443,9 @@ class RODatabase(object):
         # Cache miss
         if cls is None:
             cls = self.get_handler_class(key)
+        # Trusted mode: the cache starts at the current HEAD
+        if self.trusted and self.cache_head is None:
+            self.cache_head = self._get_head()
         # Build the handler and update the cache
         handler = object.__new__(cls)
         self.push_handler(key, handler)
@@ -449,11 +605,13 @@ class RODatabase(object):
 
 
     def save_changes(self):
-        return
+        self.catalog_synced = False
+        self.cache_synced = False
 
 
     def abort_changes(self):
-        return
+        self.catalog_synced = False
+        self.cache_synced = False
 
 
     def push_phantom(self, key, handler):
@@ -469,12 +627,15 @@ class RODatabase(object):
     # Git
     #######################################################################
     def get_blob(self, sha, cls):
-        if sha in self.git_cache:
-            return self.git_cache[sha]
+        key = (sha, cls)
+        blob = self.git_cache.get(key)
+        if blob is not None:
+            return blob
 
-        blob = self.worktree.lookup(sha)
+        # Cache the handler, not the Git blob
+        blob = self.worktree.repo[sha]
         blob = cls(string=blob.data)
-        self.git_cache[sha] = blob
+        self.git_cache.set(key, blob)
         return blob
 
 
@@ -501,8 +662,94 @@ class RODatabase(object):
             return None
 
 
-    def search(self, query=None, **kw):
+    def sync_catalog(self):
+        """Reopens the catalog if it is behind the Git HEAD, this is to say
+        if the writer process has committed since the catalog was opened
+        (the catalog records the commit it is synchronized with).
+
+        This is called by 'search' once per transaction, so the results
+        stay consistent until 'save_changes' or 'abort_changes' is called,
+        i.e. for the length of a request.
+        """
+        self.catalog_synced = True
+        catalog = self.catalog
+        if catalog is None:
+            return
+
+        head = self._get_head()
+        if head is not None and head == catalog.get_commit():
+            return
+
+        catalog.reopen()
+
+
+    def _get_head(self):
+        """Returns the SHA of the Git HEAD, or None if there is not any
+        commit yet.
+        """
+        head = self.worktree._resolve_reference('HEAD')
+        return getattr(head, 'hex', head)
+
+
+    def sync_cache(self):
+        """Trusted mode: discards the handlers of the files changed since the
+        Git commit the cache is synchronized with, if the HEAD has moved.
+        If the changes cannot be known, every handler in the cache is
+        checked against the filesystem.
+
+        This is called once per transaction, on the first cache hit.
+        """
+        self.cache_synced = True
+        head = self._get_head()
+        cache_head = self.cache_head
+        self.cache_head = head
+        if head == cache_head:
+            return
+
+        # The HEAD the handlers come from is not known (the cache was filled
+        # before the trusted mode was set), or the changes cannot be known
+        cache = self.cache
+        changed = None
+        if cache_head is not None:
+            try:
+                changed = self.worktree.get_files_changed(cache_head, head)
+            except EnvironmentError:
+                pass
+
+        if changed is None:
+            # Full check
+            for key, handler in cache.items():
+                self._check_filesystem(key, handler)
+            return
+
+        for key in changed:
+            handler = cache.get(key)
+            if handler is not None and handler.dirty is None:
+                self._discard_handler(key)
+
+
+    def search(self, query=None, deadline=None, **kw):
         """Launch a search in the catalog.
+
+        If "deadline" is given, every match is limited to that number of
+        seconds; the results found so far are returned, and flagged as
+        partial (see SearchResults.partial).  The limit is only enforced
+        with Xapian >= 1.4: there is not Enquire.set_time_limit in Xapian
+        1.2, so there the deadline does not stop the match.  Note that the
+        "partial" flag is a guess, from the wall-clock time of the match.
         """
-        xquery = _get_xquery(self.catalog, query, **kw)
-        return SearchResults(self, xquery)
+        if not self.catalog_synced:
+            self.sync_catalog()
+
+        catalog = self.catalog
+        key = _get_query_key(query, kw)
+
+        # Cache
+        cache = catalog.search_cache
+        xquery = cache.get((key, 'xquery'))
+        if xquery is None:
+            xquery = _get_xquery(catalog, query, **kw)
+            cache.set((key, 'xquery'), xquery)
+
+        query = [query if query is not None else kw]
+        return SearchResults(self, xquery, key, query, deadline)
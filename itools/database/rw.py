@@ -19,21 +19,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from cPickle import dump, load, HIGHEST_PROTOCOL
 from datetime import datetime
 from heapq import heappush, heappop
+from marshal import dumps
+from multiprocessing import Pool, cpu_count
+from os import fsync, rename
 from os.path import dirname
+from tempfile import mkdtemp
+
+# Import from xapian
+from xapian import Database, WritableDatabase, DB_CREATE, inmemory_open
 
 # Import from pygit2
 import pygit2
-from pygit2 import TreeBuilder, GIT_FILEMODE_TREE
+from pygit2 import TreeBuilder, GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE
 from pygit2 import GIT_CHECKOUT_FORCE, GIT_CHECKOUT_REMOVE_UNTRACKED
 
 # Import from itools
 from itools.core import get_pipe, lazy
 from itools.fs import lfs
 from itools.handlers import Folder
-from itools.log import log_error
-from catalog import Catalog, make_catalog
+from itools.log import log_error, log_info
+from itools.loop import cron
+from catalog import Catalog, make_catalog, _get_shard_paths
 from git import open_worktree
 from registry import get_register_fields
 from ro import RODatabase
@@ -93,13 +102,136 @@ class Heap(object):
 
 
 
+class PathSet(object):
+    """
+    A set of relative paths, like 'a/b/c', indexed by folder.  Besides the
+    subset of the set API used by RWDatabase (add, discard, remove, clear,
+    len, in and iteration), there are queries by folder:
+
+       >>> paths.is_folder('a/b')
+       >>> names = paths.get_names('a/b')
+       >>> paths = paths.get_paths('a/b')
+
+    These cost O(depth + results), there is no need to scan every path.
+
+    This data structure is used by RWDatabase to keep the files added in the
+    current transaction.
+    """
+
+    def __init__(self):
+        self._paths = set()
+        # {folder: {name: number of paths in the folder 'folder/name'}}
+        self._folders = {}
+
+
+    def __len__(self):
+        return len(self._paths)
+
+
+    def __iter__(self):
+        return iter(self._paths)
+
+
+    def __contains__(self, path):
+        return path in self._paths
+
+
+    def add(self, path):
+        if path in self._paths:
+            return
+
+        self._paths.add(path)
+        folders = self._folders
+        folder = ''
+        for name in path.split('/'):
+            names = folders.setdefault(folder, {})
+            names[name] = names.get(name, 0) + 1
+            folder = '%s/%s' % (folder, name) if folder else name
+
+
+    def discard(self, path):
+        if path not in self._paths:
+            return
+
+        self._paths.remove(path)
+        folders = self._folders
+        folder = ''
+        for name in path.split('/'):
+            names = folders[folder]
+            n = names[name] - 1
+            if n:
+                names[name] = n
+            else:
+                del names[name]
+                if not names:
+                    del folders[folder]
+            folder = '%s/%s' % (folder, name) if folder else name
+
+
+    def remove(self, path):
+        if path not in self._paths:
+            raise KeyError, path
+        self.discard(path)
+
+
+    def clear(self):
+        self._paths.clear()
+        self._folders.clear()
+
+
+    def is_folder(self, folder):
+        """Returns whether there are paths in the given folder.
+        """
+        return folder in self._folders
+
+
+    def get_names(self, folder):
+        """Returns the names of the files and folders directly in the given
+        folder.
+        """
+        return self._folders.get(folder, {}).keys()
+
+
+    def get_paths(self, folder):
+        """Returns the paths in the given folder, at any depth.
+        """
+        folders = self._folders
+        paths = self._paths
+        results = []
+        stack = [folder] if folder in folders else []
+        while stack:
+            folder = stack.pop()
+            for name in folders[folder]:
+                path = '%s/%s' % (folder, name) if folder else name
+                if path in paths:
+                    results.append(path)
+                if path in folders:
+                    stack.append(path)
+        return results
+
+
+
 class RWDatabase(RODatabase):
 
-    def __init__(self, path, size_min, size_max):
-        super(RWDatabase, self).__init__(path, size_min, size_max)
+    # If True the changes to the catalog are written to a queue by the
+    # commit, and indexed later (see index_queued_documents)
+    background_indexing = False
+    # The interval, in seconds, to index the queue in the background
+    index_interval = 2
+    # If True the commits are written straight to the Git object store,
+    # without the index file (which will be left behind the HEAD, so for
+    # instance 'git status' will show differences, until it is refreshed by
+    # check_database)
+    direct_commit = False
+
+
+    def __init__(self, path, size_min, size_max, bytes_min=None,
+                 bytes_max=None):
+        super(RWDatabase, self).__init__(path, size_min, size_max, bytes_min,
+                                         bytes_max)
 
         # The "git add" arguments
-        self.added = set()
+        self.added = PathSet()
         self.changed = set()
         self.removed = set()
         self.has_changed = False
@@ -143,6 +275,14 @@ class RWDatabase(RODatabase):
         self.resources_old2new = {}
         self.resources_new2old = {}
 
+        # Background indexing
+        self.index_queue = '%s/catalog.queue' % self.path
+        self.index_cron = False
+        # The changes left in the queue (e.g. by a restart) are indexed
+        if self._get_queued_names():
+            cron(self._index_queued_documents_cron, self.index_interval)
+            self.index_cron = True
+
 
     @lazy
     def catalog(self):
@@ -150,6 +290,11 @@ class RWDatabase(RODatabase):
         return Catalog(path, get_register_fields())
 
 
+    def sync_catalog(self):
+        # The writable catalog is always up to date
+        self.catalog_synced = True
+
+
     #######################################################################
     # Layer 0: handlers
     #######################################################################
@@ -165,22 +310,19 @@ class RWDatabase(RODatabase):
         key = self.normalize_key(key)
 
         # A new file/directory is only in added
-        n = len(key)
-        for f_key in self.added:
-            if f_key[:n] == key and (len(f_key) == n or f_key[n] == '/'):
-                return True
+        added = self.added
+        if key in added or added.is_folder(key):
+            return True
 
         # Normal case
         return super(RWDatabase, self).has_handler(key)
 
 
     def _get_handler(self, key, cls=None, soft=False):
-        # A hook to handle the new directories
-        base = key + '/'
-        n = len(base)
-        for f_key in self.added:
-            if f_key[:n] == base:
-                return Folder(key, database=self)
+        # A hook to handle the new directories (not the root, which is
+        # always in the filesystem)
+        if key and self.added.is_folder(key):
+            return Folder(key, database=self)
 
         # The other files
         return super(RWDatabase, self)._get_handler(key, cls, soft)
@@ -223,10 +365,9 @@ class RWDatabase(RODatabase):
 
         # Case 2: folder
         base = key + '/'
-        for k in self.added.copy():
-            if k.startswith(base):
-                self._discard_handler(k)
-                self.added.discard(k)
+        for k in self.added.get_paths(key):
+            self._discard_handler(k)
+            self.added.discard(k)
 
         for k in self.changed.copy():
             if k.startswith(base):
@@ -276,13 +417,8 @@ class RWDatabase(RODatabase):
         names = super(RWDatabase, self).get_handler_names(key)
         names = set(names)
 
-        # In added
-        base = key + '/'
-        n = len(base)
-        for f_key in self.added:
-            if f_key[:n] == base:
-                name = f_key[n:].split('/', 1)[0]
-                names.add(name)
+        # In added (the new files in the root folder too)
+        names.update(self.added.get_names(key))
 
         # Remove .git
         if key == "":
@@ -361,13 +497,12 @@ class RWDatabase(RODatabase):
         # Case 2: Folder
         n = len(source)
         base = source + '/'
-        for key in self.added.copy():
-            if key.startswith(base):
-                new_key = '%s%s' % (target, key[n:])
-                handler = cache.pop(key)
-                self.push_handler(new_key, handler)
-                self.added.remove(key)
-                self.added.add(new_key)
+        for key in self.added.get_paths(source):
+            new_key = '%s%s' % (target, key[n:])
+            handler = cache.pop(key)
+            self.push_handler(new_key, handler)
+            self.added.remove(key)
+            self.added.add(new_key)
 
         for key in self.changed.copy():
             if key.startswith(base):
@@ -499,6 +634,7 @@ class RWDatabase(RODatabase):
 
 
     def abort_changes(self):
+        self.cache_synced = False
         if not self.has_changed:
             return
 
@@ -521,6 +657,7 @@ class RWDatabase(RODatabase):
         worktree = self.worktree
 
         # 1. Synchronize the handlers and the filesystem
+        blobs = {} # {key: data}
         added = self.added
         for key in added:
             handler = self.cache.get(key)
@@ -528,27 +665,40 @@ class RWDatabase(RODatabase):
                 parent_path = dirname(key)
                 if not self.fs.exists(parent_path):
                     self.fs.make_folder(parent_path)
-                handler.save_state()
+                blobs[key] = handler.save_state()
 
         changed = self.changed
         for key in changed:
             handler = self.cache[key]
-            handler.save_state()
+            blobs[key] = handler.save_state()
 
         # 2. Build the 'git commit' command
         git_author, git_date, git_msg, docs_to_index, docs_to_unindex = data
         git_msg = git_msg or 'no comment'
 
-        # 3. Git add
-        git_add = list(added) + list(changed)
-        worktree.git_add(*git_add)
-
-        # 4. Create the tree
+        # 3. Git add (or create the blobs, without the index)
         repo = worktree.repo
-        index = repo.index
         try:
             head = repo.revparse_single('HEAD')
         except KeyError:
+            head = None
+        # The first commit is made from the index
+        direct_commit = self.direct_commit and head is not None
+
+        git_add = list(added) + list(changed)
+        if direct_commit:
+            entries = self._create_blobs(git_add, blobs, head.tree)
+        else:
+            worktree.git_add(*git_add)
+            index = repo.index
+            entries = {}
+            if head is not None:
+                for key in git_add:
+                    entry = index[key]
+                    entries[key] = (entry.oid, entry.mode)
+
+        # 4. Create the tree
+        if head is None:
             git_tree = None
         else:
             root = head.tree
@@ -556,8 +706,7 @@ class RWDatabase(RODatabase):
             heap = Heap()
             heap[''] = repo.TreeBuilder(root)
             for key in git_add:
-                entry = index[key]
-                heap[key] = (entry.oid, entry.mode)
+                heap[key] = entries[key]
             for key in self.removed:
                 heap[key] = None
 
@@ -605,23 +754,60 @@ class RWDatabase(RODatabase):
                     tb.insert(name, value[0], value[1])
 
         # 5. Git commit
-        worktree.git_commit(git_msg, git_author, git_date, tree=git_tree)
+        commit = worktree.git_commit(git_msg, git_author, git_date,
+                                     tree=git_tree,
+                                     write_index=not direct_commit)
 
         # 6. Clear state
         changed.clear()
         added.clear()
         self.removed.clear()
+        # The handlers in the cache are those of the new commit
+        self.cache_head = commit.hex
 
         # 7. Catalog
+        # (the documents to reindex are replaced, no need to unindex them)
         catalog = self.catalog
+        docs_to_index = [ x[1] for x in docs_to_index ]
+        if self.background_indexing:
+            self._queue_documents(commit.hex, docs_to_index, docs_to_unindex)
+            return
+        reindex = set([ str(x.get('abspath')) for x in docs_to_index ])
         for path in docs_to_unindex:
-            catalog.unindex_document(path)
-        for resource, values in docs_to_index:
-            catalog.index_document(values)
+            if str(path) not in reindex:
+                catalog.unindex_document(path)
+        catalog.index_documents(docs_to_index)
+        catalog.set_commit(commit.hex)
         catalog.save_changes()
 
 
+    def _create_blobs(self, keys, blobs, tree):
+        """Writes the given files to the Git object store, returns a dict
+        from key to (oid, mode), to build the tree.  The data is taken from
+        'blobs' (the data written by the handlers), or else read from the
+        filesystem.  The mode of the files already in the given tree is
+        kept.
+        """
+        create_blob = self.worktree.repo.create_blob
+        entries = {}
+        for key in keys:
+            data = blobs.get(key)
+            if data is None:
+                file = self.fs.open(key)
+                try:
+                    data = file.read()
+                finally:
+                    file.close()
+            try:
+                mode = tree[key].filemode
+            except KeyError:
+                mode = GIT_FILEMODE_BLOB
+            entries[key] = (create_blob(data), mode)
+        return entries
+
+
     def save_changes(self):
+        self.cache_synced = False
         if not self.has_changed:
             return
 
@@ -653,13 +839,204 @@ class RWDatabase(RODatabase):
 
 
 
-def make_git_database(path, size_min, size_max, fields=None):
+    #######################################################################
+    # Catalog
+    #######################################################################
+    def catchup_catalog(self):
+        """Brings the catalog up to date with the Git HEAD, when it has
+        been left behind (e.g. indexing failed, or the catalog has been
+        restored from a backup).  Only the resources whose metadata file
+        changed since the commit recorded by the catalog are reindexed or
+        unindexed.
+
+        This replays too the changes of the files of the queue that could
+        not be read (see index_queued_documents).
+
+        Returns the number of resources reindexed or unindexed.  Raises
+        ValueError if the catalog does not know its commit, then a full
+        reindex is needed.
+        """
+        # First the changes queued (see background_indexing)
+        self.index_queued_documents()
+
+        catalog = self.catalog
+        since = catalog.get_commit()
+        if since is None:
+            error = 'the catalog commit is unknown, a full reindex is needed'
+            raise ValueError, error
+
+        worktree = self.worktree
+        until = self._get_head()
+        if since == until:
+            return 0
+
+        # Reindex or unindex the resources that changed
+        n = 0
+        docs_to_index = []
+        for path in worktree.get_files_changed(since, until):
+            if path[-9:] != '.metadata':
+                continue
+            abspath = '/%s' % path[:-9]
+            resource = self.get_resource(abspath, soft=True)
+            if resource is None:
+                catalog.unindex_document(abspath)
+            else:
+                docs_to_index.append(resource.get_catalog_values())
+            n += 1
+        catalog.index_documents(docs_to_index)
+
+        # Save
+        catalog.set_commit(until)
+        catalog.save_changes()
+
+        # The changes of the broken files of the queue have been replayed
+        queue = self.index_queue
+        for name in self._get_broken_names():
+            lfs.remove('%s/%s' % (queue, name))
+        return n
+
+
+    def _queue_documents(self, commit, docs_to_index, docs_to_unindex):
+        """Writes the changes to the catalog made by the given commit to the
+        queue, to be indexed later.  Until then, the searches see them
+        through the overlay of the catalog.
+        """
+        entries = [ (str(x), None) for x in docs_to_unindex ]
+        entries.extend([ (str(x['abspath']), x) for x in docs_to_index ])
+
+        # The queue is a folder with one file by commit, numbered
+        queue = self.index_queue
+        if lfs.exists(queue):
+            # Do not reuse the numbers of the broken files
+            names = self._get_queued_names() + self._get_broken_names()
+            names.sort()
+            seq = int(names[-1].split('.')[0]) + 1 if names else 0
+        else:
+            lfs.make_folder(queue)
+            seq = 0
+
+        # Write (the file is renamed once complete, and on disk)
+        path = '%s/%010d' % (queue, seq)
+        with open('%s.tmp' % path, 'wb') as f:
+            dump((commit, entries), f, HIGHEST_PROTOCOL)
+            f.flush()
+            fsync(f.fileno())
+        rename('%s.tmp' % path, '%s.queue' % path)
+
+        # The overlay
+        catalog = self.catalog
+        for abspath, values in entries:
+            if values is None:
+                catalog.overlay_unindex_document(abspath, seq)
+            else:
+                catalog.overlay_index_document(values, seq)
+        catalog.save_changes()
+
+        # Index in the background
+        if not self.index_cron:
+            cron(self._index_queued_documents_cron, self.index_interval)
+            self.index_cron = True
+
+
+    def _get_queued_names(self):
+        queue = self.index_queue
+        if not lfs.exists(queue):
+            return []
+        return [ x for x in lfs.get_names(queue) if x[-6:] == '.queue' ]
+
+
+    def _get_broken_names(self):
+        queue = self.index_queue
+        if not lfs.exists(queue):
+            return []
+        return [ x for x in lfs.get_names(queue) if x[-7:] == '.broken' ]
+
+
+    def index_queued_documents(self):
+        """Indexes the changes to the catalog written to the queue by the
+        commits (see background_indexing), in one batch, and removes them
+        from the overlay.  Returns the number of commits indexed.
+
+        This is called in the background by the main loop; it must be
+        called explicitly if there is not a main loop running.
+
+        The files of the queue that cannot be read are moved aside (renamed
+        to "*.broken"), and the catalog is left at the commit before them,
+        so catchup_catalog will reindex their changes (until then the catalog
+        commit is not advanced).
+        """
+        names = sorted(self._get_queued_names())
+        if not names:
+            return 0
+
+        # Load, the last change of every document wins
+        queue = self.index_queue
+        documents = {}
+        loaded = []
+        commit = None
+        broken = len(self._get_broken_names()) > 0
+        for name in names:
+            path = '%s/%s' % (queue, name)
+            try:
+                with open(path, 'rb') as f:
+                    queued_commit, entries = load(f)
+            except Exception:
+                log_error('Cannot read the queue file "%s"' % path,
+                          domain='itools.database')
+                rename(path, '%s.broken' % path[:-6])
+                broken = True
+                continue
+            if not broken:
+                commit = queued_commit
+            loaded.append(name)
+            for abspath, values in entries:
+                documents[abspath] = values
+
+        # Index
+        catalog = self.catalog
+        docs_to_index = []
+        for abspath, values in documents.iteritems():
+            if values is None:
+                catalog.unindex_document(abspath)
+            else:
+                docs_to_index.append(values)
+        catalog.index_documents(docs_to_index)
+        if commit is not None:
+            catalog.set_commit(commit)
+        catalog.save_changes()
+
+        # Clean
+        for name in loaded:
+            lfs.remove('%s/%s' % (queue, name))
+        catalog.clear_overlay(int(names[-1].split('.')[0]))
+        return len(loaded)
+
+
+    def _index_queued_documents_cron(self):
+        # Keep going while there are changes queued
+        try:
+            self.index_queued_documents()
+        except Exception:
+            log_error('Background indexing failed', domain='itools.database')
+            return True
+
+        if self._get_queued_names():
+            return True
+        self.index_cron = False
+        return False
+
+
+
+def make_git_database(path, size_min, size_max, fields=None, shards=None,
+                      router=None):
     """Create a new empty Git database if the given path does not exists or
     is a folder.
 
     If the given path is a folder with content, the Git archive will be
     initialized and the content of the folder will be added to it in a first
     commit.
+
+    The "shards" and "router" parameters are those of make_catalog.
     """
     path = lfs.get_absolute_path(path)
     # Git init
@@ -667,7 +1044,7 @@ def make_git_database(path, size_min, size_max, fields=None):
     # The catalog
     if fields is None:
         fields = get_register_fields()
-    catalog = make_catalog('%s/catalog' % path, fields)
+    catalog = make_catalog('%s/catalog' % path, fields, shards, router)
     # Ok
     database = RWDatabase(path, size_min, size_max)
     database.catalog = catalog
@@ -684,6 +1061,11 @@ def check_database(target):
     """
     cwd = '%s/database' % target
 
+    # Refresh the index, it is left behind the HEAD by the direct commits
+    # (see RWDatabase.direct_commit).  The changes not committed are still
+    # found in the working tree.
+    get_pipe(['git', 'reset', '-q'], cwd=cwd)
+
     # Check modifications to the working tree not yet in the index.
     command = ['git', 'ls-files', '-m', '-d', '-o']
     data1 = get_pipe(command, cwd=cwd)
@@ -705,3 +1087,175 @@ def check_database(target):
     print '  $ git checkout -f'
     print
     return False
+
+
+
+###########################################################################
+# Parallel reindex
+###########################################################################
+# The fields are not picklable, they are passed to the workers through fork
+_reindex_fields = None
+
+
+def _reindex_load(args):
+    """Worker, first pass: loads the resources and computes their catalog
+    values, which are pickled to the given file.  Returns the number of
+    documents and the names of the fields found (with the multilingual
+    fields expanded), as a dict from name to the name of the base field.
+    """
+    path, abspaths, filename = args
+    database = RODatabase(path)
+    names = {}
+    n = 0
+    with open(filename, 'wb') as file:
+        for abspath in abspaths:
+            resource = database.get_resource(abspath, soft=True)
+            if resource is None:
+                continue
+            values = resource.get_catalog_values()
+            for name, value in values.iteritems():
+                names[name] = None
+                if type(value) is dict:
+                    for language in value:
+                        names['%s_%s' % (name, language)] = name
+            dump(values, file, HIGHEST_PROTOCOL)
+            n += 1
+            # Free memory
+            database.make_room()
+
+    return n, names
+
+
+def _reindex_index(args):
+    """Worker, second pass: builds a partial catalog from the values
+    computed by the first pass.  All the partial catalogs share the same
+    metadata, so they can be merged.
+
+    The partial catalog is not transactional, the documents are written to
+    disk every "flush_docs" documents.
+    """
+    filename, part, metadata, commit, flush_docs = args
+    db = WritableDatabase(part, DB_CREATE)
+    db.set_metadata('metadata', metadata)
+    if commit:
+        db.set_metadata('commit', commit)
+    catalog = Catalog(db, _reindex_fields, asynchronous_mode=False)
+    with catalog.bulk(flush_docs=flush_docs) as bulk:
+        with open(filename, 'rb') as file:
+            while True:
+                try:
+                    values = load(file)
+                except EOFError:
+                    break
+                bulk.index_document(values)
+    catalog._flush()
+    db.close()
+    return part
+
+
+def _compact(sources, target):
+    """Merges the given Xapian databases into the target path, compacted.
+    """
+    # Xapian >= 1.3
+    if hasattr(Database, 'compact'):
+        db = Database()
+        for source in sources:
+            db.add_database(Database(source))
+        db.compact(target)
+        return
+
+    # Xapian 1.2
+    from xapian import Compactor
+    compactor = Compactor()
+    compactor.set_destdir(target)
+    for source in sources:
+        compactor.add_source(source)
+    compactor.compact()
+
+
+def reindex_catalog(path, n_workers=None, fields=None, flush_docs=10000):
+    """Rebuilds from scratch the catalog of the database at the given path,
+    splitting the work across "n_workers" processes (by default as many as
+    CPUs).  Every worker opens its own read-only database and builds a
+    partial catalog, then these are merged and compacted to replace the
+    current catalog.  The partial catalogs are written to disk every
+    "flush_docs" documents, to bound the memory used by the workers.
+
+    This is an offline operation: the resource classes must be registered
+    before calling this function, and no other process should be writing
+    to the database.  Returns the number of documents indexed.
+
+    The sharded catalogs are not supported (the partial catalogs are merged
+    into a single database), a ValueError is raised.
+    """
+    global _reindex_fields
+
+    path = lfs.get_absolute_path(path)
+    if _get_shard_paths('%s/catalog' % path):
+        raise ValueError, 'the reindex of sharded catalogs is not supported'
+    if fields is None:
+        fields = get_register_fields()
+    _reindex_fields = fields
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    # The resources, from the metadata files
+    worktree = open_worktree('%s/database' % path)
+    abspaths = [ '/%s' % x[:-9] for x in worktree.walk()
+                 if x[-9:] == '.metadata' ]
+    abspaths.sort()
+    # The commit the new catalog will be synchronized with
+    commit = worktree._resolve_reference('HEAD')
+    commit = getattr(commit, 'hex', commit)
+
+    tmp = mkdtemp(prefix='.reindex-', dir=path)
+    try:
+        pool = Pool(n_workers)
+        try:
+            # 1. Compute the catalog values
+            filenames = [ '%s/values-%d' % (tmp, i) for i in range(n_workers) ]
+            args = [ (path, abspaths[i::n_workers], filenames[i])
+                     for i in range(n_workers) ]
+            names = {}
+            n = 0
+            for n_docs, x in pool.map(_reindex_load, args):
+                names.update(x)
+                n += n_docs
+
+            # 2. The metadata, the same for all the partial catalogs
+            catalog = Catalog(inmemory_open(), fields, asynchronous_mode=False)
+            metadata = catalog._metadata
+            for name in sorted(names):
+                base = names[name]
+                field_cls = fields[base or name]
+                info = catalog._get_info(field_cls, name)
+                if base:
+                    info['from'] = base
+                metadata[name] = info
+            for name in sorted(catalog._sort_profiles):
+                catalog._get_sort_info(name)
+            metadata = dumps(metadata)
+
+            # 3. Build the partial catalogs
+            args = [ (filenames[i], '%s/part-%d' % (tmp, i), metadata, commit,
+                      flush_docs)
+                     for i in range(n_workers) ]
+            parts = pool.map(_reindex_index, args)
+        finally:
+            pool.close()
+            pool.join()
+
+        # 4. Merge
+        target = '%s/catalog.new' % tmp
+        _compact(parts, target)
+
+        # 5. Replace the catalog
+        catalog = '%s/catalog' % path
+        if lfs.exists(catalog):
+            rename(catalog, '%s/catalog.old' % tmp)
+        rename(target, catalog)
+    finally:
+        lfs.remove(tmp)
+
+    log_info('reindexed %d documents' % n, domain='itools.database')
+    return n
@@ -52,6 +52,10 @@ class File(Handler):
     timestamp = None
     dirty = None
 
+    # The estimated size in memory, in bytes, of the handlers of this class
+    # that do not keep their data as a string (see get_cache_size)
+    cache_size = 1024
+
 
     def __init__(self, key=None, string=None, database=None, **kw):
         if database is not None:
@@ -137,19 +141,23 @@ class File(Handler):
 
 
     def save_state(self):
+        """Saves the handler to the file, returns the data written (if
+        available, see save_state_to_file).
+        """
         if not self.dirty:
-            return
+            return None
 
         # Save
         file = self.database.fs.open(self.key, 'w')
         try:
-            self.save_state_to_file(file)
+            data = self.save_state_to_file(file)
         finally:
             file.close()
 
         # Update timestamp/dirty
         self.timestamp = self.database.fs.get_mtime(self.key)
         self.dirty = None
+        return data
 
 
     def save_state_to(self, key):
@@ -179,6 +187,7 @@ class File(Handler):
         # pointer pointing to the beginning)
         file.write(data)
         file.truncate(file.tell())
+        return data
 
 
     clone_exclude = frozenset(['database', 'key', 'timestamp', 'dirty'])
@@ -258,6 +267,20 @@ class File(Handler):
     #########################################################################
     # API
     #########################################################################
+    def get_cache_size(self):
+        """Returns the estimated size in memory of the handler, in bytes,
+        this is used by the database to bound the memory used by its cache.
+        """
+        # Not loaded
+        if self.timestamp is None and self.dirty is None:
+            return 0
+
+        data = self.__dict__.get('data')
+        if type(data) is str or type(data) is unicode:
+            return len(data)
+        return self.cache_size
+
+
     def get_mtime(self):
         """Returns the last modification time.
         """
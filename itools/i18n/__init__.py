@@ -24,6 +24,7 @@ from languages import has_language, get_languages, get_language_name
 from locale_ import format_date, format_time, format_datetime
 from locale_ import format_number
 from oracle import guess_language, is_asian_character, is_punctuation
+from oracle import split_punctuation
 
 
 
@@ -47,6 +48,7 @@ __all__ = [
     'guess_language',
     'is_asian_character',
     'is_punctuation',
+    'split_punctuation',
     # languages
     'has_language',
     'get_languages',
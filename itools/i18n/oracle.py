@@ -17,119 +17,84 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# Import from the Standard Library
+from re import compile, UNICODE
+
+
+###########################################################################
+# Character classes
+###########################################################################
+# The ranges of asian characters, see
+# http://en.wikipedia.org/wiki/Template:Unicode_chart_<Range_Name>
+asian_ranges = [
+    (0x3300, 0x33FF), # CJK Compatibility
+    (0xFE30, 0xFE4F), # CJK Compatibility Forms
+    (0xF900, 0xFAFF), # CJK Compatibility Ideographs
+    (0x2E80, 0x2EFF), # CJK Radicals Supplement
+    (0x31C0, 0x31EF), # CJK Strokes
+    (0x4E00, 0x9FBF), # CJK Unified Ideographs
+    (0x3400, 0x4DBF), # CJK Unified Ideographs Extension A
+    (0xFF00, 0xFFEF), # Halfwidth and Fullwidth Forms
+#   (0x3130, 0x318F), # Hangul Compatibility Jamo
+#   (0x1100, 0x11FF), # Hangul Jamo
+#   (0xAC00, 0xD7AF), # Hangul Syllables
+    (0x3040, 0x309F), # Hiragana
+    (0x30A0, 0x30FF), # Katakana
+    (0x31F0, 0x31FF), # Katakana Phonetic Extensions
+    ]
+
+# Punctuation: what is not alphanumeric, plus the General Punctuation
+# (2000-206F) and CJK Symbols and Punctuation (3000-303F) ranges
+punctuation_expr = compile(u'[\\W_\u2000-\u206f\u3000-\u303f]', UNICODE)
+# The words: sequences of characters that are not punctuation
+words_expr = compile(u'[^\\W_\u2000-\u206f\u3000-\u303f]+', UNICODE)
+
+
+# The class of every character in the Basic Multilingual Plane, one byte by
+# code point
+PUNCTUATION = 1
+ASIAN = 2
+
+def make_char_table():
+    table = bytearray(0x10000)
+    for first, last in asian_ranges:
+        table[first:last+1] = chr(ASIAN) * (last + 1 - first)
+
+    chars = u''.join([ unichr(x) for x in range(0x10000) ])
+    for match in punctuation_expr.finditer(chars):
+        table[match.start()] |= PUNCTUATION
+
+    return table
+
+char_table = make_char_table()
+
+
+
 def is_asian_character(c):
+    code = ord(c)
+    if code > 0xFFFF:
+        return False
+    return char_table[code] & ASIAN != 0
 
-    # get the decimal value of the character
-    code = int('%04x' % ord(c), 16)
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Compatibility
-    # CJK Compatibility
-    # Range: 3300–33FF
-    if code >= 13056 and code <= 13311:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Compatibility_Forms
-    # CJK Compatibility Forms
-    # Range: FE30–FE4F
-    if code >= 65072 and code <= 65103:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Compatibility_Ideographs
-    # CJK Compatibility Ideographs
-    # Range: F900–FAFF
-    if code >= 63744 and code <= 64255:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Radicals_Supplement
-    # CJK Radicals Supplement
-    # Range: 2E80–2EFF
-    if code >= 11904 and code <= 12031:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Strokes
-    # CJK Strokes
-    # Range: 31C0–31EF
-    if code >= 12736 and code <= 12783:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Unified_Ideographs
-    # CJK Unified Ideographs
-    # Range: 4E00–9FBF
-    if code >= 19968 and code <= 40895:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Unified_Ideographs_Extension_A
-    # CJK Unified Ideographs Extension A
-    # Range: 3400–4DBF
-    if code >= 13312 and code <= 19903:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Halfwidth_and_Fullwidth_Forms
-    # Halfwidth and Fullwidth Forms
-    # Range: FF00–FFEF
-    if code >= 65280 and code <= 65519 :
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Hangul_Compatibility_Jamo
-    # Hangul Compatibility Jamo
-    # Range: 3130–318F
-    #if code >= 12592 and code <= 12687:
-    #    return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Hangul_Jamo
-    # Hangul Jamo
-    # Range: 1100–11FF
-    #if code >= 4352 and code <= 4607:
-    #    return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Hangul_Syllables
-    # Hangul Syllables
-    # Range: AC00–D7AF
-    #if code >= 44032 and code <= 55215:
-    #    return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Hiragana
-    # Hiragana
-    # Range: 3040–309F
-    if code >= 12352 and code <= 12447:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Katakana
-    # Katakana
-    # Range: 30A0–30FF
-    if code >= 12448 and code <= 12543:
-        return True
-
-    # http://en.wikipedia.org/wiki/Template:Unicode_chart_Katakana_Phonetic_Extensions
-    # Katakana Phonetic Extensions
-    # Range: 31F0–31FF
-    if code >= 12784 and code <= 12799:
-        return True
-
-    return False
 
 
 def is_punctuation(c):
-    """Check if c is a punctuation symbol
-    http://en.wikipedia.org/wiki/Template:Unicode_chart_General_Punctuation
-    General Punctuation
-    Range: 2000–206F
-
-    http://en.wikipedia.org/wiki/Template:Unicode_chart_CJK_Symbols_and_Punctuation
-    CJK Symbols and Punctuation
-    Range: 3000–303F
+    """Check if c is a punctuation symbol: not alphanumeric, or in the
+    General Punctuation (2000-206F) and CJK Symbols and Punctuation
+    (3000-303F) ranges.
     """
+    code = ord(c)
+    if code > 0xFFFF:
+        return c.isalnum() is False
+    return char_table[code] & PUNCTUATION != 0
 
-    # call isalnum before check character code
-    if c.isalnum() is False:
-        return True
 
-    # get the decimal value of the character
-    code = int('%04x' % ord(c), 16)
-    if (code >= 8192 and code <= 8303) or (code >= 12288 and code <= 12351):
-        return True
 
-    return False
+def split_punctuation(text):
+    """Returns the words in the given text, where a word is a sequence of
+    characters that are not punctuation (see 'is_punctuation').
+    """
+    return words_expr.findall(text)
 
 
 ###########################################################################
@@ -20,7 +20,7 @@ from unittest import TestCase, main
 
 # Import from itools
 from itools.core import freeze, frozenlist, frozendict
-from itools.core import LRUCache
+from itools.core import LRUCache, WeightedLRUCache
 
 
 ###########################################################################
@@ -419,6 +419,31 @@ class CacheTestCase(TestCase):
 
 
 
+class WeightedCacheTestCase(TestCase):
+
+    def test_weight(self):
+        cache = WeightedLRUCache(length_max=3, weight_max=10, get_weight=len)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        # 'b' is the least-recently used
+        cache.set('c', 'cccc')
+        self.assert_('b' not in cache)
+        self.assertEqual(cache.weight, 8)
+        # Too heavy
+        cache.set('d', 'd' * 11)
+        self.assert_('d' not in cache)
+        # Bound by the length
+        cache.set('e', 'e')
+        cache.set('f', 'f')
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('b'), None)
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['evictions'], 2)
+
+
+
 if __name__ == '__main__':
     main()
 
@@ -19,24 +19,38 @@
 
 # Import from the Standard Library
 from unittest import TestCase, main
+from os import chmod
 from os.path import basename
 from random import sample
+from time import time
 import re
 
 # Import from itools
 from itools.database import AndQuery, RangeQuery, PhraseQuery, NotQuery
 from itools.database import AllQuery, OrQuery, TextQuery
 from itools.database import make_catalog, Catalog, Resource, StartQuery
-from itools.database import make_git_database
-from itools.database.catalog import _index, _decode
+from itools.database import make_git_database, RODatabase, reindex_catalog
+from itools.database import check_database
+from itools.database import shard_by_hash, shard_by_prefix
+from itools.database.catalog import _index, _decode, Analyzer, get_analyzer
+from itools.database.git import get_blob_sha, ObjectCache
+from itools.database.metadata import DefaultField, Metadata, MetadataCache
+from itools.database.rw import PathSet
+from itools.csv import Property, fold_line
 from itools.datatypes import String, Unicode, Boolean, Integer
 from itools.fs import lfs, FileName
-from itools.handlers import TextFile
+from itools.handlers import Folder, TextFile
 from itools.log.log import register_logger, Logger, FATAL
 
+# Import from pygobject
+from gobject import main_context_default
+
 # Import from xapian
 from xapian import Document as XapianDocument
 
+# Import from pygit2
+from pygit2 import GIT_FILEMODE_BLOB_EXECUTABLE
+
 
 
 class BrokenHandler(TextFile):
@@ -73,6 +87,17 @@ class RWDatabaseTestCase(TestCase):
                 lfs.remove(path)
 
 
+    def test_make_room_bytes(self):
+        database = self.database
+        database.cache_bytes_min = 1000
+        database.cache_bytes_max = 2000
+        for i in range(10):
+            database.get_handler('%02d.txt' % i).to_str()
+        self.assert_(database.get_cache_size() > 2000)
+        database.make_room()
+        self.assert_(database.get_cache_size() <= 1000)
+
+
     def test_abort(self):
         # Changes (copy&paste)
         fables = self.root
@@ -97,6 +122,144 @@ class RWDatabaseTestCase(TestCase):
         self.assertEqual(lfs.exists('fables/database/31.txt'), True)
 
 
+    def test_root_folder(self):
+        database = self.database
+        self.root.set_handler('31.txt', TextFile(data=u'31'))
+        # The root is a folder, loaded as usual
+        root = database._get_handler('')
+        self.assert_(type(root) is Folder)
+        self.assertEqual(root.key, '')
+        # The new files are listed
+        self.assert_('31.txt' in database.get_handler_names(''))
+        self.assert_('.git' not in database.get_handler_names(''))
+
+
+    def test_direct_commit(self):
+        database = self.database
+        database.direct_commit = True
+        self.root.set_handler('31.txt', TextFile(data=u'31'))
+        database.save_changes()
+        # In the commit, not in the index
+        worktree = database.worktree
+        head = worktree.repo.revparse_single('HEAD')
+        blob = worktree.lookup_from_commit_by_path(head, '31.txt')
+        self.assertEqual(blob.data, '31')
+        self.assert_('31.txt' not in worktree.index)
+        # Remove
+        self.root.del_handler('31.txt')
+        database.save_changes()
+        head = worktree.repo.revparse_single('HEAD')
+        self.assertEqual(
+            worktree.lookup_from_commit_by_path(head, '31.txt'), None)
+        # The database is consistent
+        self.assertEqual(check_database('fables'), True)
+
+
+    def test_direct_commit_mode(self):
+        database = self.database
+        worktree = database.worktree
+        # An executable file
+        with open('fables/database/31.txt', 'w') as f:
+            f.write('31')
+        chmod('fables/database/31.txt', 0755)
+        worktree.git_add('31.txt')
+        worktree.git_commit('An executable file')
+        # Change it
+        database.direct_commit = True
+        handler = self.root.get_handler('31.txt')
+        handler.set_data(u'32')
+        database.save_changes()
+        # The mode is kept
+        head = worktree.repo.revparse_single('HEAD')
+        self.assertEqual(head.tree['31.txt'].filemode,
+                         GIT_FILEMODE_BLOB_EXECUTABLE)
+
+
+    def test_git_log_paths(self):
+        database = self.database
+        worktree = database.worktree
+        # A tiny cache: the objects are not the same from lookup to lookup
+        worktree.cache = ObjectCache(length_max=1)
+        self.root.set_handler('31.txt', TextFile(data=u'31'))
+        database.save_changes()
+        with open('fables/database/broken.txt', 'w') as f:
+            f.write('broken')
+        worktree.git_add('broken.txt')
+        worktree.git_commit('Another file')
+        self.assertEqual(len(worktree.git_log(paths=['31.txt'])), 1)
+
+
+    def test_catalog_commit(self):
+        database = self.database
+        fables = self.root
+        fables.set_handler('31.txt', TextFile())
+        database.save_changes()
+        # The catalog knows the last commit
+        head = database.worktree.git_log(n=1)[0]['sha']
+        self.assertEqual(database.catalog.get_commit(), head)
+        # Nothing to catch up
+        self.assertEqual(database.catchup_catalog(), 0)
+
+
+    def test_trusted(self):
+        database = self.database
+        reader = RODatabase('fables')
+        reader.trusted = True
+        data = reader.get_handler('30.txt').to_str()
+        reader.abort_changes()
+        try:
+            # Change the file, not a commit: the cache is trusted
+            with open('fables/database/30.txt', 'w') as f:
+                f.write('changed')
+            self.assertEqual(reader.get_handler('30.txt').to_str(), data)
+            reader.abort_changes()
+            # Commit: the handler is discarded
+            database.touch_handler('30.txt')
+            database.save_changes()
+            self.assertEqual(reader.get_handler('30.txt').to_str(),
+                             'changed')
+        finally:
+            with open('fables/database/30.txt', 'w') as f:
+                f.write(data)
+
+
+    def test_trusted_commit_before_hit(self):
+        database = self.database
+        reader = RODatabase('fables')
+        reader.trusted = True
+        data = reader.get_handler('30.txt').to_str()
+        reader.abort_changes()
+        try:
+            # Commit before the first cache hit
+            with open('fables/database/30.txt', 'w') as f:
+                f.write('changed')
+            database.touch_handler('30.txt')
+            database.save_changes()
+            self.assertEqual(reader.get_handler('30.txt').to_str(),
+                             'changed')
+        finally:
+            with open('fables/database/30.txt', 'w') as f:
+                f.write(data)
+
+
+    def test_watch(self):
+        reader = RODatabase('fables')
+        reader.watch()
+        try:
+            with open('fables/database/31.txt', 'w') as f:
+                f.write('31')
+            self.assertEqual(reader.get_handler('31.txt').to_str(), '31')
+            # Removed by another process
+            lfs.remove('fables/database/31.txt')
+            context = main_context_default()
+            t0 = time()
+            while '31.txt' in reader.cache and time() - t0 < 5:
+                context.iteration(False)
+            self.assert_('31.txt' not in reader.cache)
+        finally:
+            reader.unwatch()
+
+
     def test_broken_commit(self):
         # Changes (copy&paste)
         fables = self.root
@@ -154,6 +317,161 @@ def split(field_cls, value, language='en'):
 
 
 
+class PathSetTestCase(TestCase):
+
+    def test_folders(self):
+        paths = PathSet()
+        for path in ['a/b/c', 'a/b/d', 'a/e', 'f']:
+            paths.add(path)
+        self.assertEqual(sorted(paths.get_names('a')), ['b', 'e'])
+        self.assertEqual(sorted(paths.get_paths('a')),
+                         ['a/b/c', 'a/b/d', 'a/e'])
+        self.assert_(paths.is_folder('a/b'))
+        self.assert_(not paths.is_folder('a/e'))
+        # Remove
+        paths.discard('a/b/c')
+        paths.remove('a/b/d')
+        self.assert_(not paths.is_folder('a/b'))
+        self.assertEqual(paths.get_names('a'), ['e'])
+        self.assertEqual(len(paths), 2)
+
+
+
+class MetadataCacheTestCase(TestCase):
+
+    def test_cache(self):
+        cache = MetadataCache(size_max=1000)
+        state = ('text', None, {'title': Property(u'Hello')})
+        cache.set('a' * 40, state)
+        # A copy
+        format, version, properties = cache.get('a' * 40)
+        self.assertEqual(properties['title'].value, u'Hello')
+        self.assert_(properties is not state[2])
+        # Eviction
+        cache.set('b' * 40, ('text', None, {'data': 'x' * 2000}))
+        self.assertEqual(cache.get('b' * 40), None)
+        self.assert_(cache.weight <= 1000)
+        # Blob SHA
+        self.assertEqual(get_blob_sha('hello\n'),
+                         'ce013625030ba8dba906f756967f9e9ca394464a')
+
+
+    def test_persistent(self):
+        path = 'tests/metadata.cache'
+        cache = MetadataCache(size_max=1000, path=path)
+        cache.set('a' * 40, ('text', None, {'title': [('title:Hello\n',
+                                                      'Hello', {})]}))
+        cache.save()
+        try:
+            # Loaded from disk
+            cache = MetadataCache(size_max=1000, path=path)
+            format, version, properties = cache.get('a' * 40)
+            self.assertEqual(format, 'text')
+            self.assertEqual(properties['title'][0][1], 'Hello')
+            self.assertEqual(cache.changed, False)
+        finally:
+            lfs.remove(path)
+
+
+
+class Note(object):
+    """A resource class, and a database, for the metadata tests.
+    """
+
+    fields_soft = False
+    fields = {
+        'description': DefaultField(datatype=Unicode, multiple=False),
+        'tags': DefaultField,
+        'title': DefaultField(datatype=Unicode, multiple=False,
+                              multilingual=True,
+                              parameters_schema={'lang': String})}
+
+
+    @classmethod
+    def get_field(cls, name):
+        return cls.fields.get(name)
+
+
+    def get_resource_class(self, class_id):
+        return Note
+
+
+    def touch_handler(self, key, handler):
+        pass
+
+
+
+class MetadataTestCase(TestCase):
+
+    def setUp(self):
+        description = ' '.join([ 'word%d' % i for i in range(30) ])
+        self.data = ('format:note\n'
+                     + fold_line('description:%s\n' % description)
+                     + 'tags:a\n'
+                     + 'tags:b\n'
+                     + 'title;lang=en:Hello\n'
+                     + 'title;lang=fr:Bonjour\n')
+        self.metadata = Metadata(string=self.data, database=Note())
+
+
+    def test_to_str(self):
+        self.assertEqual(self.metadata.to_str(), self.data)
+
+
+    def test_lazy(self):
+        metadata = self.metadata
+        self.assertEqual(metadata.get_property('title', 'fr').value,
+                         u'Bonjour')
+        self.assertEqual(metadata._properties.keys(), ['title'])
+        self.assertEqual(sorted(metadata._raw_properties),
+                         ['description', 'tags'])
+        # Still the same
+        self.assertEqual(metadata.to_str(), self.data)
+
+
+    def test_set_del(self):
+        metadata = self.metadata
+        metadata.set_property('tags', Property('c'))
+        self.assertEqual([ x.value for x in metadata.get_property('tags') ],
+                         ['a', 'b', 'c'])
+        metadata.del_property('description')
+        self.assertEqual(metadata.has_property('description'), False)
+        self.assertEqual(metadata.get_property('description'), None)
+        self.assert_('tags:c\n' in metadata.to_str())
+        self.assert_('description' not in metadata.to_str())
+
+
+    def test_missing_language(self):
+        data = 'format:note\ntitle:Hello\n'
+        self.assertRaises(ValueError, Metadata, string=data,
+                          database=Note())
+
+
+
+class ObjectCacheTestCase(TestCase):
+
+    def test_cache(self):
+        cache = ObjectCache(length_max=2, size_max=100)
+        hello = TextFile(string='hello')
+        cache.set('a', hello)
+        self.assert_(cache.get('a') is hello)
+        self.assertEqual(cache.weight, 5)
+        # Bound by the number of objects
+        cache.set('b', TextFile(string='b'))
+        cache.set('c', TextFile(string='c'))
+        self.assert_('a' not in cache)
+        # Bound by the size
+        cache.set('d', TextFile(string='x' * 100))
+        self.assertEqual(len(cache), 1)
+        self.assert_(cache.weight <= 100)
+        # Statistics
+        self.assertEqual(cache.get('b'), None)
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['evictions'], 3)
+
+
+
 class FieldsTestCase(TestCase):
 
     def test_boolean_true(self):
@@ -193,6 +511,18 @@ class FieldsTestCase(TestCase):
         self.assertEqual(words, expected)
 
 
+    def test_analyzer(self):
+        # Analyzers are reused
+        self.assert_(get_analyzer('fr') is get_analyzer('fr'))
+        # Stemming
+        analyzer = Analyzer('en', stemming=True)
+        xdoc = XapianDocument()
+        analyzer.index_text(xdoc, u'The wolves were jumping', '', 1)
+        terms = [ x.term for x in xdoc ]
+        self.assert_('jumping' in terms)
+        self.assert_('Zjump' in terms)
+
+
     def test_text_russian(self):
         text = u'Это наш дом'
         words = split(Unicode, text, 'ru')
@@ -391,7 +721,11 @@ class CatalogTestCase(TestCase):
 
 
     def tearDown(self):
-        paths = ['fables/catalog', 'fables/database/.git']
+        paths = ['fables/catalog', 'fables/catalog.queue',
+                 'fables/database/.git']
+        fables = lfs.open('fables/database')
+        paths += [ 'fables/database/%s' % x for x in fables.get_names()
+                   if x.endswith('.metadata') ]
         for path in paths:
             if lfs.exists(path):
                 lfs.remove(path)
@@ -442,6 +776,138 @@ class CatalogTestCase(TestCase):
         self.assertEqual(len(results), 2)
 
 
+    def test_count(self):
+        results = self.database.search(data=u'lion')
+        # Estimate
+        lower, estimate, upper = results.get_count()
+        self.assert_(lower <= 5 <= upper)
+        self.assert_(lower <= estimate <= upper)
+        # Exact
+        self.assertEqual(results.get_count(exact=True), 5)
+        # All the documents, without counting them first
+        self.assertEqual(len(results.get_documents()), 5)
+
+
+    def test_search_cache(self):
+        database = self.database
+        cache = database.catalog.search_cache
+        cache.clear()
+        # Miss, then hit
+        hits = cache.hits
+        docs = database.search(data=u'lion').get_documents()
+        self.assertEqual(len(docs), 5)
+        docs = database.search(data=u'lion').get_documents()
+        self.assertEqual(len(docs), 5)
+        self.assertEqual(cache.hits, hits + 2)
+        # Invalidated by the changes
+        database.catalog.unindex_document('03.txt')
+        self.assertEqual(len(database.search(data=u'lion')), 4)
+        database.catalog.abort_changes()
+        self.assertEqual(len(database.search(data=u'lion')), 5)
+
+
+    def test_reindex(self):
+        database = self.database
+        catalog = database.catalog
+        # Index again: the document is replaced
+        catalog.index_document(Document('fables/database/03.txt'))
+        self.assertEqual(len(database.search(data=u'lion')), 5)
+        self.assertEqual(len(database.search(abspath='03.txt')), 1)
+
+
+    def test_reindex_catalog(self):
+        database = self.database
+        # The resources
+        for name in lfs.get_names('fables/database'):
+            if name.endswith('.txt') or name.endswith('.txt.fr'):
+                with open('fables/database/%s.metadata' % name, 'w') as f:
+                    f.write('format:fable\n')
+        database.worktree.git_add('.')
+        database.worktree.git_commit('Metadata')
+        head = database.worktree.git_log(n=1)[0]['sha']
+        # Reindex
+        n = reindex_catalog('fables', 2, Document.fields, flush_docs=10)
+        self.assertEqual(n, 32)
+        catalog = Catalog('fables/catalog', Document.fields, read_only=True)
+        self.assertEqual(catalog._db.get_doccount(), 32)
+        self.assertEqual(len(catalog.search(data=u'lion')), 5)
+        self.assertEqual(catalog.get_commit(), head)
+
+
+    def test_catchup_catalog(self):
+        database = self.database
+        catalog = database.catalog
+        worktree = database.worktree
+        for name in ['03.txt', '08.txt']:
+            with open('fables/database/%s.metadata' % name, 'w') as f:
+                f.write('format:fable\n')
+        worktree.git_add('.')
+        worktree.git_commit('Metadata')
+        since = worktree.git_log(n=1)[0]['sha']
+        # The catalog is at this commit, with 08.txt but not 03.txt
+        catalog.index_document(database.get_resource('/08.txt'))
+        catalog.set_commit(since)
+        catalog.save_changes()
+        # Change 03.txt, remove 08.txt
+        with open('fables/database/03.txt.metadata', 'w') as f:
+            f.write('format;version=1:fable\n')
+        worktree.git_add('03.txt.metadata')
+        worktree.git_commit('Change')
+        worktree.git_rm('08.txt.metadata')
+        worktree.git_commit('Remove')
+        until = worktree.git_log(n=1)[0]['sha']
+        # Catch up
+        self.assertEqual(database.catchup_catalog(), 2)
+        self.assertEqual(catalog.get_commit(), until)
+        self.assertEqual(len(database.search(abspath='/03.txt')), 1)
+        self.assertEqual(len(database.search(abspath='/08.txt')), 0)
+
+
+    def test_sort_profile(self):
+        database = self.database
+        catalog = database.catalog
+        # Reindex with a sort profile
+        catalog._sort_profiles = {'lang_abspath': ('lang', 'abspath')}
+        fables = lfs.open('fables/database')
+        for name in fables.get_names():
+            _, ext, _ = FileName.decode(name)
+            if ext == 'txt':
+                abspath = fables.get_absolute_path(name)
+                catalog.index_document(Document(abspath))
+        self.assertNotEqual(catalog._get_sort_value(['lang', 'abspath']), None)
+        # Sort
+        results = database.search(data=u'lion')
+        docs = results.get_documents(sort_by=['lang', 'abspath'])
+        keys = [ (x.lang, x.abspath) for x in docs ]
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(keys, sorted(keys))
+        # Paginate
+        sort_by = ['lang', 'abspath']
+        docs, cursor = results.search_after(size=2, sort_by=sort_by)
+        pages = [ (x.lang, x.abspath) for x in docs ]
+        while cursor is not None:
+            docs, cursor = results.search_after(cursor, 2, sort_by)
+            pages.extend([ (x.lang, x.abspath) for x in docs ])
+        self.assertEqual(pages, keys)
+
+
+    def test_reopen(self):
+        # A reader
+        reader = RODatabase('fables')
+        reader.catalog = Catalog('fables/catalog', Document.fields,
+                                 read_only=True)
+        self.assertEqual(len(reader.search(data=u'lion')), 5)
+        # The writer commits
+        catalog = self.database.catalog
+        catalog.unindex_document('03.txt')
+        catalog.save_changes()
+        # Same transaction, same results
+        self.assertEqual(len(reader.search(data=u'lion')), 5)
+        # New transaction, the catalog is reopened
+        reader.abort_changes()
+        self.assertEqual(len(reader.search(data=u'lion')), 4)
+
+
     def test_AndQuery_empty(self):
         query = AndQuery()
         query.append(PhraseQuery('data', u'mouse'))
@@ -549,6 +1015,130 @@ class CatalogTestCase(TestCase):
         self.assertEqual(fr.title_fr, u'Bonjour le monde')
 
 
+    def test_projection(self):
+        results = self.database.search(data=u'lion')
+        rows = results.get_documents(sort_by='abspath',
+                                     fields=['abspath', 'count'])
+        abspaths = [ x.abspath for x in rows ]
+        self.assertEqual(
+            abspaths, ['03.txt', '08.txt', '10.txt', '23.txt', '99.txt.fr'])
+        # The same values than the lazy documents
+        docs = results.get_documents(sort_by='abspath')
+        for row, doc in zip(rows, docs):
+            self.assertEqual(row.count, doc.count)
+        # Not stored
+        self.assertRaises(ValueError, results.get_documents,
+                          fields=['data'])
+
+
+    def test_search_after(self):
+        results = self.database.search(data=u'lion')
+        expected = results.get_documents(sort_by='abspath')
+        expected = [ x.abspath for x in expected ]
+        for reverse in (False, True):
+            abspaths = []
+            docs, cursor = results.search_after(size=2, sort_by='abspath',
+                                                reverse=reverse)
+            abspaths.extend([ x.abspath for x in docs ])
+            while cursor is not None:
+                docs, cursor = results.search_after(cursor, 2, 'abspath',
+                                                    reverse)
+                abspaths.extend([ x.abspath for x in docs ])
+            if reverse:
+                abspaths.reverse()
+            self.assertEqual(abspaths, expected)
+        # Not unique, or sorted by relevance
+        self.assertRaises(ValueError, results.search_after, sort_by='is_long')
+        self.assertRaises(ValueError, results.search_after)
+
+
+    def test_query_stats(self):
+        stats = self.database.catalog.query_stats
+        stats.reset()
+        records = []
+        stats.add_hook(records.append)
+        results = self.database.search(data=u'lion')
+        results.get_documents(sort_by='abspath', fields=['abspath'])
+        results.search(lang='fr').get_documents()
+        self.assertEqual(stats.get_stats()['searches'], 2)
+        self.assertEqual(stats.get_stats()['docs'], 6)
+        # The records
+        first, second = records
+        self.assertEqual(first['sort'], 'abspath')
+        self.assertEqual(first['size'], 5)
+        self.assertEqual(second['sort'], 'relevance')
+        self.assert_("'lang'" in second['query'])
+
+
+    def test_deadline(self):
+        database = self.database
+        results = database.search(data=u'lion', deadline=10.0)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results.partial, False)
+        # A match that lasts as long as the deadline gives partial results
+        database.catalog.search_cache.clear()
+        results = database.search(data=u'lion', deadline=1e-9)
+        results.get_documents()
+        self.assertEqual(results.partial, True)
+        # Wildcards expanding to too many terms do not fail, and are limited
+        catalog = database.catalog
+        query = TextQuery('data', u'w*')
+        n = len(database.search(query).get_documents())
+        catalog.max_expansion = 1
+        catalog._query_parsers.clear()
+        catalog.search_cache.clear()
+        docs = database.search(query).get_documents()
+        self.assert_(len(docs) < n)
+
+
+    def test_background_indexing(self):
+        database = self.database
+        database.index_cron = True
+        # Queue the changes
+        values = Document('fables/database/03.txt').get_catalog_values()
+        values['lang'] = 'fr'
+        database._queue_documents('0' * 40, [values], ['10.txt'])
+        self.assertEqual(len(database._get_queued_names()), 1)
+        # The overlay
+        self.assertEqual(len(database.search(data=u'lion')), 4)
+        self.assertEqual(len(database.search(lang='fr')), 3)
+        # Index
+        self.assertEqual(database.index_queued_documents(), 1)
+        self.assertEqual(database.catalog._overlay, {})
+        self.assertEqual(database.catalog.get_commit(), '0' * 40)
+        self.assertEqual(len(database.search(data=u'lion')), 4)
+        self.assertEqual(len(database.search(lang='fr')), 3)
+
+
+    def test_background_indexing_broken(self):
+        database = self.database
+        database.index_cron = True
+        database._queue_documents('0' * 40, [], ['10.txt'])
+        # A truncated file
+        with open('fables/catalog.queue/0000000001.queue', 'wb') as f:
+            f.write('')
+        # It is moved aside, the commit is not advanced past it
+        self.assertEqual(database.index_queued_documents(), 1)
+        self.assertEqual(database._get_queued_names(), [])
+        self.assert_(lfs.exists('fables/catalog.queue/0000000001.broken'))
+        self.assertEqual(database.catalog.get_commit(), '0' * 40)
+        self.assertEqual(len(database.search(abspath='10.txt')), 0)
+        # The next drains do not advance the commit past the broken file
+        database._queue_documents('1' * 40, [], ['08.txt'])
+        self.assert_(lfs.exists('fables/catalog.queue/0000000002.queue'))
+        self.assertEqual(database.index_queued_documents(), 1)
+        self.assertEqual(database.catalog.get_commit(), '0' * 40)
+
+
+    def test_facets(self):
+        results = self.database.search(name='hello')
+        facets = results.get_facets(['lang'])
+        self.assertEqual(facets['lang'], {'de': 1, 'en': 1, 'es': 1, 'fr': 1})
+        # Limit
+        facets = results.get_facets(['lang'], limit=2)
+        self.assertEqual(len(facets['lang']), 2)
+
+
     def test_multiple(self):
         doc = self.database.search(lang='es').get_documents()[0]
         self.assertEqual(doc.count, [1, 2, 11])
@@ -575,6 +1165,120 @@ class BugXapianTestCase(TestCase):
 
 
 
+class BulkIndexTestCase(TestCase):
+
+    def setUp(self):
+        make_catalog('tests/catalog', Document_4.fields)
+
+
+    def tearDown(self):
+        lfs.remove('tests/catalog')
+
+
+    def test_index_documents(self):
+        cat = Catalog('tests/catalog', Document_4.fields)
+        documents = [ Document_4('%02d.txt' % i) for i in range(5) ]
+        stats = cat.index_documents(documents, flush_docs=2)
+        cat.save_changes()
+        self.assertEqual(stats['docs'], 5)
+        self.assertEqual(stats['flushes'], 2)
+        self.assertEqual(cat._db.get_doccount(), 5)
+        # The metadata has been written
+        cat = Catalog('tests/catalog', Document_4.fields, read_only=True)
+        self.assert_('abspath' in cat._metadata)
+
+
+
+class ShardedCatalogTestCase(TestCase):
+
+    def setUp(self):
+        make_catalog('tests/catalog', Document_4.fields, shards=3)
+
+
+    def tearDown(self):
+        lfs.remove('tests/catalog')
+
+
+    def test_shards(self):
+        cat = Catalog('tests/catalog', Document_4.fields)
+        self.assertEqual(len(cat._shards), 3)
+        for i in range(10):
+            cat.index_document(Document_4('%02d.txt' % i))
+        cat.save_changes()
+        self.assertEqual(cat._db.get_doccount(), 10)
+        self.assertEqual(sum([ x.get_doccount() for x in cat._shards ]), 10)
+        # Only the shard of the document is modified
+        cat.unindex_document('03.txt')
+        self.assertEqual(len(cat._dirty), 1)
+        cat.save_changes()
+        # Read-only
+        cat = Catalog('tests/catalog', Document_4.fields, read_only=True)
+        self.assertEqual(cat._db.get_doccount(), 9)
+        self.assert_('abspath' in cat._metadata)
+
+
+    def test_router(self):
+        fields = Document_4.fields
+        make_catalog('tests/catalog/prefix', fields, shards=3,
+                     router=shard_by_prefix)
+        try:
+            # The router is stored in the catalog
+            cat = Catalog('tests/catalog/prefix', fields)
+            self.assert_(cat._router is shard_by_prefix)
+            self.assertRaises(ValueError, Catalog, 'tests/catalog/prefix',
+                              fields, router=shard_by_hash)
+            # Long paths are routed by the abspath, not by the key term
+            for name in ['a', 'b' * 300]:
+                cat.index_document(Document_4('folder/%s' % name))
+            cat.save_changes()
+            counts = [ x.get_doccount() for x in cat._shards ]
+            self.assertEqual(sorted(counts), [0, 0, 2])
+            # Replace
+            cat = Catalog('tests/catalog/prefix', fields)
+            cat.index_document(Document_4('folder/%s' % ('b' * 300)))
+            cat.save_changes()
+            self.assertEqual(cat._db.get_doccount(), 2)
+        finally:
+            lfs.remove('tests/catalog/prefix')
+
+
+    def test_commit_order(self):
+        cat = Catalog('tests/catalog', Document_4.fields)
+        for i in range(10):
+            cat.index_document(Document_4('%02d.txt' % i))
+        cat.set_commit('1' * 40)
+        # The commit of the other shards fails
+        shards = cat._shards
+        for i in range(1, len(shards)):
+            shards[i] = FailingShard(shards[i])
+        self.assertRaises(IOError, cat.save_changes)
+        # The commit is not saved
+        cat = Catalog('tests/catalog', Document_4.fields, read_only=True)
+        self.assertEqual(cat.get_commit(), None)
+
+
+    def test_reindex(self):
+        # Not supported
+        self.assertRaises(ValueError, reindex_catalog, 'tests', 1,
+                          Document_4.fields)
+
+
+
+class FailingShard(object):
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+    def __getattr__(self, name):
+        return getattr(self.shard, name)
+
+
+    def commit_transaction(self):
+        raise IOError, 'commit failed'
+
+
+
 class Document(Resource):
 
     fields = {
@@ -624,6 +1328,25 @@ class Document(Resource):
 
 
 
+class Fable(Document):
+    """The resource of the fables, to test reindex_catalog.
+    """
+
+    class_id = 'fable'
+
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+
+    def get_catalog_values(self):
+        abspath = str(self.abspath)
+        values = Document('fables/database%s' % abspath).get_catalog_values()
+        values['abspath'] = abspath
+        return values
+
+
+
 class Document_4(Resource):
 
     fields = {'abspath': String(stored=True, indexed=True)}
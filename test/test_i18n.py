@@ -25,6 +25,7 @@ from sys import version_info
 # Import from itools
 from itools.i18n import is_similar, get_most_similar, guess_language
 from itools.i18n import AcceptLanguageType, format_number
+from itools.i18n import is_asian_character, is_punctuation, split_punctuation
 
 
 
@@ -245,6 +246,29 @@ class OracleTestCase(TestCase):
 
 
 
+class CharactersTestCase(TestCase):
+
+    def test_punctuation(self):
+        for c in u' .,;_\u2000\u3000\u3001':
+            self.assertEqual(is_punctuation(c), True)
+        for c in u'aZ9\u6771\u3042':
+            self.assertEqual(is_punctuation(c), False)
+
+
+    def test_asian_character(self):
+        for c in u'\u6771\u3042\u30a2\uff01':
+            self.assertEqual(is_asian_character(c), True)
+        for c in u'a\xe9\uac00':
+            self.assertEqual(is_asian_character(c), False)
+
+
+    def test_split_punctuation(self):
+        text = u'East equals \u6771\u4eac. West, \u897f\u3002'
+        self.assertEqual(split_punctuation(text),
+            [u'East', u'equals', u'\u6771\u4eac', u'West', u'\u897f'])
+
+
+
 ############################################################################
 # Format number
 ############################################################################